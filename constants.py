@@ -17,13 +17,29 @@ DEV_CONFIG = {
     "COMPUTE_BID_PERCENT": 75,
     "INSTANCE_CLASS": ec2.InstanceClass.C4,  
     "EBS_VOL_SIZE": 100,   
+    "INPUT_CACHE_SIZE": 80, # Size limit (GB) of the host input cache kept on the EBS volume, below EBS_VOL_SIZE
+    "INPUT_CACHE_METRICS_NAMESPACE": 'CPB/InputCache', # CloudWatch namespace of the input cache hit ratio metrics
+    "FSX_STORAGE_CAPACITY": 1200, # FSx for Lustre storage capacity (GiB)
+    "FSX_THROUGHPUT_PER_TIB": 50, # FSx for Lustre throughput (MB/s per TiB of storage)
+    "MULTI_AZ": False, # Give each AZ its own compute environment, job queue and FSx filesystem
+    "MAX_AZS": 2, # Number of AZs used by the multi-AZ layout
     # DOCKER INSTANCE RUNNING ENVIRONMENT:
     "JOB_CPU": 4,  
     "JOB_MEMORY": 4096,    
     "JOB_ATTEMPTS": 3, 
     "JOB_TIMEOUT": 1500, 
+    # JOB RIGHT-SIZING FROM RECORDED RUN PROFILES:
+    "PROFILE_SAFETY_MARGIN": 0.2, # Headroom added on top of the largest recorded peak memory and CPU use
+    "PROFILE_HISTORY": 20, # Number of most recent runs per profile considered for a prediction
+    # ILLUMINATION CORRECTION:
+    "ILLUM_CACHE_PREFIX": 'illum-cache', # Bucket prefix caching illumination functions per plate and pipeline
     # SQS QUEUE INFORMATION:
     "SQS_MESSAGE_VISIBILITY": 1200, # Timeout (secs) for messages  
+    "LAMBDA_TIMEOUT": 120, # Timeout (secs) of the Lambda submitting the jobs of a batch of messages, below SQS_MESSAGE_VISIBILITY
+    # OUTPUT UPLOAD:
+    "OUTPUT_MODE": 'files', # 'files' uploads every output file, 'sharded' packs small files into tar shards
+    "OUTPUT_SHARD_SIZE_MB": 256, # Maximum size of a single output shard
+    "OUTPUT_SMALL_FILE_MB": 8, # Output files smaller than this are packed into shards
     # PLUGINS
     "REQUIREMENTS_FILE": '/files/requirements.txt', # Path within the CellProfiler-plugins repo to a requirements file
 }
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Read-through input cache shared by the containers on a host.
+
+The cache lives on the instance's EBS volume, mounted into every container through a
+host volume. Input files are stored once per host under their S3 ETag and size, so jobs
+reading the same images only read them from FSx the first time. The job's input folder
+is built from hard links to the cached files, which keeps them readable while the cache
+evicts least recently used files to stay under its size limit.
+
+Layout of the cache directory:
+
+    objects/<etag[:2]>/<etag>-<size>   cached files, mtime is the last use
+    jobs/<job>/                        input folders built for running jobs
+    tmp/                               partially copied files
+    stats.json                         hit and miss counters since the host started
+    .mounted                           written by the host once the cache volume is mounted
+"""
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import boto3
+
+# Job folders left behind by jobs that didn't clean up are removed after a day
+STALE_JOB_SECONDS = 24 * 60 * 60
+
+
+@contextmanager
+def cache_lock(cache):
+    """
+    Hold an exclusive lock on the cache while updating its stats or evicting files.
+    """
+    with open(os.path.join(cache, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def list_inputs(bucket, prefix):
+    """
+    Yield the path relative to the prefix, ETag and size of every object under the prefix.
+    """
+    paginator = boto3.client("s3").get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            relpath = obj["Key"][len(prefix):].lstrip("/")
+            if relpath and not obj["Key"].endswith("/"):
+                yield relpath, obj["ETag"].strip('"'), obj["Size"]
+
+
+def stage(bucket, prefix, source, cache, dest):
+    """
+    Build dest from hard links to the cached copies of the inputs, copying missing files
+    from source into the cache first. Return the job's hit and miss counters.
+    """
+    for name in ("objects", "jobs", "tmp"):
+        os.makedirs(os.path.join(cache, name), exist_ok=True)
+
+    stats = {"hits": 0, "misses": 0, "hit_bytes": 0, "miss_bytes": 0}
+    for relpath, etag, size in list_inputs(bucket, prefix):
+        blob = os.path.join(cache, "objects", etag[:2], f"{etag}-{size}")
+        if os.path.exists(blob):
+            os.utime(blob)
+            stats["hits"] += 1
+            stats["hit_bytes"] += size
+        else:
+            # Copy to a temporary file first so other containers never see a partial file.
+            # Its name must be unique across containers, whose PIDs repeat.
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.join(cache, "tmp"), prefix=f"{etag}-{size}.")
+            os.close(fd)
+            try:
+                shutil.copyfile(os.path.join(source, relpath), tmp)
+                os.chmod(tmp, 0o644)
+                os.replace(tmp, blob)
+            except BaseException:
+                os.remove(tmp)
+                raise
+            stats["misses"] += 1
+            stats["miss_bytes"] += size
+
+        target = os.path.join(dest, relpath)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(blob, target)
+        except FileNotFoundError:
+            # Evicted by another container in between, copy it again
+            shutil.copyfile(os.path.join(source, relpath), target)
+    return stats
+
+
+def evict(cache, max_size):
+    """
+    Remove the least recently used cached files until the cache fits in max_size bytes,
+    and the job folders of jobs that didn't clean up. Return the number of evicted files.
+    """
+    now = time.time()
+    jobs = os.path.join(cache, "jobs")
+    for name in os.listdir(jobs):
+        path = os.path.join(jobs, name)
+        if now - os.path.getmtime(path) > STALE_JOB_SECONDS:
+            shutil.rmtree(path, ignore_errors=True)
+
+    blobs = []
+    total = 0
+    for root, _, files in os.walk(os.path.join(cache, "objects")):
+        for name in files:
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            blobs.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+    evicted = 0
+    for _, size, path in sorted(blobs):
+        if total <= max_size:
+            break
+        os.remove(path)
+        total -= size
+        evicted += 1
+    return evicted
+
+
+def record_stats(cache, job_stats, evicted):
+    """
+    Add the job's counters to the host's stats and return them.
+    """
+    path = os.path.join(cache, "stats.json")
+    host_stats = {"hits": 0, "misses": 0, "hit_bytes": 0, "miss_bytes": 0, "evictions": 0}
+    if os.path.exists(path):
+        with open(path) as f:
+            host_stats.update(json.load(f))
+    for key, value in job_stats.items():
+        host_stats[key] += value
+    host_stats["evictions"] += evicted
+    with open(path, "w") as f:
+        json.dump(host_stats, f)
+    return host_stats
+
+
+def hit_ratio(stats):
+    lookups = stats["hits"] + stats["misses"]
+    return stats["hits"] / lookups if lookups else 0.0
+
+
+def publish_metrics(namespace, job_stats, host_stats):
+    """
+    Publish the job's cache counters and the host's hit ratio to CloudWatch.
+    """
+    boto3.client("cloudwatch").put_metric_data(
+        Namespace=namespace,
+        MetricData=[
+            {"MetricName": "Hits", "Value": job_stats["hits"], "Unit": "Count"},
+            {"MetricName": "Misses", "Value": job_stats["misses"], "Unit": "Count"},
+            {"MetricName": "BytesFromCache", "Value": job_stats["hit_bytes"], "Unit": "Bytes"},
+            {"MetricName": "BytesFromFSx", "Value": job_stats["miss_bytes"], "Unit": "Bytes"},
+            {"MetricName": "HitRatio", "Value": hit_ratio(job_stats) * 100, "Unit": "Percent"},
+            {"MetricName": "HostHitRatio", "Value": hit_ratio(host_stats) * 100, "Unit": "Percent"},
+        ],
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--bucket", required=True, help="Bucket holding the inputs")
+    parser.add_argument("--prefix", required=True, help="Input prefix in the bucket")
+    parser.add_argument("--source", required=True, help="Input folder on FSx")
+    parser.add_argument("--cache", required=True, help="Host cache directory")
+    parser.add_argument("--dest", required=True, help="Input folder to build for the job")
+    parser.add_argument("--max-size-gb", type=float, required=True, help="Cache size limit in GB")
+    parser.add_argument("--metrics-namespace", help="CloudWatch namespace to publish the cache metrics to")
+    args = parser.parse_args(argv)
+
+    job_stats = stage(args.bucket, args.prefix, args.source, args.cache, args.dest)
+    with cache_lock(args.cache):
+        evicted = evict(args.cache, args.max_size_gb * 1024 ** 3)
+        host_stats = record_stats(args.cache, job_stats, evicted)
+
+    print(f"Input cache: {job_stats['hits']} hits, {job_stats['misses']} misses, "
+          f"hit ratio {hit_ratio(job_stats):.1%} (host {hit_ratio(host_stats):.1%}), {evicted} evicted")
+    if args.metrics_namespace:
+        try:
+            publish_metrics(args.metrics_namespace, job_stats, host_stats)
+        except Exception as e:
+            print(f"Failed to publish input cache metrics: {e}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Pack small CellProfiler output files into size-bounded tar shards.
+
+Every file under SOURCE smaller than the small-file threshold is appended to an
+uncompressed tar shard under DEST/shards/ and removed from SOURCE. A shard is
+closed before the next file would take it over the shard size limit, counting the
+tar headers and the end-of-archive padding. Files at or above the threshold are
+left in SOURCE, so the worker uploads them from there directly (with multipart for
+large files) without copying them to local disk first.
+
+An index (DEST/index.json) records, for every packed file, the shard it lives in
+and the byte offset and size of its data within that shard. Because the shards
+are not compressed, any single file can be fetched with an S3 ranged GET:
+
+    aws s3api get-object --bucket <bucket> --key <output>/shards/shard-00000.tar \
+        --range bytes=<offset>-<offset + size - 1> <file>
+"""
+import argparse
+import json
+import os
+import sys
+import tarfile
+
+SHARD_DIR = "shards"
+INDEX_FILE = "index.json"
+INDEX_VERSION = 1
+
+
+def list_files(source):
+    """
+    Return the relative paths of all regular files under source, in a stable order.
+    """
+    paths = []
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        for name in sorted(files):
+            paths.append(os.path.relpath(os.path.join(root, name), source))
+    return paths
+
+
+def padded(size):
+    """
+    Return size rounded up to whole tar blocks.
+    """
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+def archive_size(offset):
+    """
+    Return the size of a shard closed at offset, with the end-of-archive blocks and
+    the padding to a whole record that tarfile writes on close.
+    """
+    return -(-(offset + 2 * tarfile.BLOCKSIZE) // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+
+def pack_outputs(source, dest, shard_size, small_file_size):
+    """
+    Pack the small files under source into tar shards in dest, removing them from
+    source. Large files are left in source and listed in the index as uploaded
+    directly. Return the index describing the packed files.
+    """
+    shard_path = os.path.join(dest, SHARD_DIR)
+    os.makedirs(shard_path, exist_ok=True)
+
+    index = {"version": INDEX_VERSION, "shards": [], "files": {}, "direct": []}
+    shard = None
+    shard_name = None
+
+    for relpath in list_files(source):
+        path = os.path.join(source, relpath)
+        size = os.path.getsize(path)
+
+        # Large files are uploaded directly from source
+        if size >= small_file_size:
+            index["direct"].append(relpath)
+            continue
+
+        # Start a new shard when the file's header and data would take the current one
+        # over the size limit. A shard always takes at least one file.
+        if shard is not None:
+            info = shard.gettarinfo(path, arcname=relpath)
+            header = info.tobuf(shard.format, shard.encoding, shard.errors)
+            if archive_size(shard.offset + len(header) + padded(info.size)) > shard_size:
+                shard.close()
+                shard = None
+        if shard is None:
+            shard_name = f"{SHARD_DIR}/shard-{len(index['shards']):05d}.tar"
+            shard = tarfile.open(os.path.join(dest, shard_name), "w", format=tarfile.PAX_FORMAT)
+            index["shards"].append(shard_name)
+            info = shard.gettarinfo(path, arcname=relpath)
+
+        with open(path, "rb") as f:
+            shard.addfile(info, f)
+        # The member data sits right before the block padding written by addfile
+        index["files"][relpath] = {
+            "shard": shard_name,
+            "offset": shard.offset - padded(info.size),
+            "size": info.size,
+        }
+        os.remove(path)
+
+    if shard is not None:
+        shard.close()
+
+    with open(os.path.join(dest, INDEX_FILE), "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+
+    return index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("source", help="Directory holding the CellProfiler output")
+    parser.add_argument("dest", help="Staging directory to upload to S3")
+    parser.add_argument("--shard-size-mb", type=int, default=256,
+                        help="Maximum size of a single shard in MB")
+    parser.add_argument("--small-file-mb", type=int, default=8,
+                        help="Files smaller than this are packed into shards")
+    args = parser.parse_args(argv)
+
+    index = pack_outputs(
+        args.source,
+        args.dest,
+        shard_size=args.shard_size_mb * 1024 * 1024,
+        small_file_size=args.small_file_mb * 1024 * 1024,
+    )
+    print(f"Packed {len(index['files'])} files into {len(index['shards'])} shards, "
+          f"{len(index['direct'])} files uploaded directly")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
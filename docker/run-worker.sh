@@ -54,6 +54,13 @@ if [ $? -ne 0 ]; then
 fi
 log "Unique temporary directory created: $TEMP_OUTPUT_PATH"
 
+# Delete the job's working folders outside FSx however the script exits. A job folder left in the
+# host input cache would keep evicted files on the cache volume until it is removed as stale.
+cleanup() {
+    rm -rf $CACHED_INPUT_PATH $STAGED_INPUT_PATH $STAGING_PATH $RUN_PROFILE
+}
+trap cleanup EXIT
+
 log "Listing objects in Lustre file system:"
 ls $MOUNT_PATH
 
@@ -67,15 +74,90 @@ log "Output path: $OUTPUT_PATH"
 log "Pipeline path: $PIPELINE_PATH"
 log "Temperory output path: $TEMP_OUTPUT_PATH"
 
+# Read the input through the host's shared input cache when it is mounted, so images already
+# read by another container on this host don't use FSx throughput again. The host marks the
+# cache volume once it is mounted, a failed mount leaves an unmarked folder on the root disk.
+if [ -n "$INPUT_CACHE_PATH" ]; then
+    if mountpoint -q "$INPUT_CACHE_PATH" && [ -f "$INPUT_CACHE_PATH/.mounted" ]; then
+        log "Reading input through the host input cache..."
+        # Named after the job so containers on the same host never share a folder. A folder left
+        # by an earlier attempt of this job that was killed before cleaning up is replaced.
+        CACHED_INPUT_PATH="$INPUT_CACHE_PATH/jobs/${AWS_BATCH_JOB_ID:-$TEMP_OUTPUT_PATH_NAME}"
+        rm -rf $CACHED_INPUT_PATH
+        if python3.8 input-cache.py --bucket $AWS_BUCKET --prefix $INPUT --source $INPUT_PATH --cache $INPUT_CACHE_PATH --dest $CACHED_INPUT_PATH --max-size-gb ${INPUT_CACHE_SIZE_GB:-80} --metrics-namespace "$INPUT_CACHE_METRICS_NAMESPACE"; then
+            INPUT_PATH=$CACHED_INPUT_PATH
+            log "Cached input path: $INPUT_PATH"
+        else
+            log "Failed to read input through the host input cache, reading from FSx."
+            rm -rf $CACHED_INPUT_PATH
+            CACHED_INPUT_PATH=""
+        fi
+    else
+        log "Input cache volume is not mounted at $INPUT_CACHE_PATH, reading from FSx."
+    fi
+fi
+
+# Stage precomputed illumination functions next to the input images so the pipeline loads them
+# from its input folder. The images are linked, only the .npy files are copied from the cache.
+if [ -n "$ILLUM_INPUT" ]; then
+    log "Staging illumination functions from $ILLUM_INPUT..."
+    STAGED_INPUT_PATH=$(mktemp -d)
+    if ! cp -rs $INPUT_PATH/. $STAGED_INPUT_PATH/; then
+        log "Failed to link the input images."
+        exit 1
+    fi
+    if ! aws s3 cp s3://$AWS_BUCKET/$ILLUM_INPUT $STAGED_INPUT_PATH/ --recursive --exclude "*" --include "*.npy"; then
+        log "Failed to download the illumination functions. Please check the illumination cache."
+        exit 1
+    fi
+    if ! find $STAGED_INPUT_PATH -type f -name "*.npy" | grep -q .; then
+        log "No illumination functions found in $ILLUM_INPUT. Please check the illumination pipeline."
+        exit 1
+    fi
+    INPUT_PATH=$STAGED_INPUT_PATH
+    log "Staged input path: $INPUT_PATH"
+fi
+
 
 
 # Running CellProfiler with input and output directories, and metadata file
+# GNU time records peak RSS (KB), user and system CPU seconds and elapsed seconds,
+# also when CellProfiler fails or is killed for running out of memory
 log "Running CellProfiler..."
-if ! cellprofiler -c -r -p $PIPELINE_PATH -o $TEMP_OUTPUT_PATH -i $INPUT_PATH; then
-    log "Failed to run CellProfiler. Please check the paths and permissions."
+RUN_PROFILE=$(mktemp)
+/usr/bin/time -f "%M %U %S %e" -o $RUN_PROFILE cellprofiler -c -r -p $PIPELINE_PATH -o $TEMP_OUTPUT_PATH -i $INPUT_PATH
+EXIT_STATUS=$?
+if [ $EXIT_STATUS -ne 0 ]; then
+    log "Failed to run CellProfiler (exit status $EXIT_STATUS). Please check the paths and permissions."
+else
+    log "CellProfiler run completed successfully."
+fi
+
+# Record the measured resource use in the profile store, used to right-size later jobs.
+# Failed runs are recorded with their exit status, so the next jobs get more memory after an OOM kill.
+read PEAK_RSS_KB USER_SECONDS SYSTEM_SECONDS ELAPSED_SECONDS < <(tail -n 1 $RUN_PROFILE)
+PEAK_RSS_MB=$(( ${PEAK_RSS_KB:-0} / 1024 ))
+CPU_USED=$(awk -v u=$USER_SECONDS -v s=$SYSTEM_SECONDS -v e=$ELAPSED_SECONDS 'BEGIN { printf "%.2f", (e > 0) ? (u + s) / e : 0 }')
+log "Memory: requested ${REQUESTED_MEMORY:-n/a} MB, peak ${PEAK_RSS_MB} MB"
+log "vCPUs: requested ${REQUESTED_VCPUS:-n/a}, used ${CPU_USED}"
+if [ -n "$PROFILE_TABLE" ] && [ -n "$PROFILE_KEY" ]; then
+    log "Recording run profile for $PROFILE_KEY"
+    if ! aws dynamodb put-item --table-name $PROFILE_TABLE --item "{
+        \"profile_key\": {\"S\": \"$PROFILE_KEY\"},
+        \"finished_at\": {\"S\": \"$(date -u +%Y-%m-%dT%H:%M:%SZ)#${AWS_BATCH_JOB_ID:-$RANDOM}\"},
+        \"peak_rss_mb\": {\"N\": \"$PEAK_RSS_MB\"},
+        \"cpu_used\": {\"N\": \"$CPU_USED\"},
+        \"elapsed_seconds\": {\"N\": \"${ELAPSED_SECONDS:-0}\"},
+        \"requested_memory\": {\"N\": \"${REQUESTED_MEMORY:-0}\"},
+        \"requested_vcpus\": {\"N\": \"${REQUESTED_VCPUS:-0}\"},
+        \"exit_status\": {\"N\": \"$EXIT_STATUS\"}
+    }"; then
+        log "Failed to record the run profile, continuing."
+    fi
+fi
+if [ $EXIT_STATUS -ne 0 ]; then
     exit 1
 fi
-log "CellProfiler run completed successfully."
 
 # List files in output location
 log "Listing files in output location:"
@@ -85,6 +167,23 @@ if [ ! -d "$TEMP_OUTPUT_PATH" ]; then
 fi
 ls $TEMP_OUTPUT_PATH
 
+# Pack small output files into shards when the sharded output mode is selected.
+# Small files go into size-bounded tar shards with a seekable index.json alongside on
+# local disk, large files are left on FSx and uploaded directly from there.
+if [ "$OUTPUT_MODE" == "sharded" ]; then
+    log "Packing output files into shards..."
+    STAGING_PATH=$(mktemp -d)
+    if ! python3.8 pack-outputs.py $TEMP_OUTPUT_PATH $STAGING_PATH --shard-size-mb ${OUTPUT_SHARD_SIZE_MB:-256} --small-file-mb ${OUTPUT_SMALL_FILE_MB:-8}; then
+        log "Failed to pack output files into shards."
+        exit 1
+    fi
+    log "Upload output shards to S3"
+    if ! aws s3 cp $STAGING_PATH s3://$AWS_BUCKET/$OUTPUT --recursive; then
+        log "Failed to upload output shards to S3. Please check the S3 bucket and permissions."
+        exit 1
+    fi
+fi
+
 # Upload output files to S3
 log "Upload output files to S3"
 if ! aws s3 cp $TEMP_OUTPUT_PATH s3://$AWS_BUCKET/$OUTPUT --recursive; then
@@ -92,6 +191,14 @@ if ! aws s3 cp $TEMP_OUTPUT_PATH s3://$AWS_BUCKET/$OUTPUT --recursive; then
     exit 1
 fi
 
+# Mark the output complete once every file is uploaded, readers of the output wait for the marker
+if [ -n "$OUTPUT_MARKER" ]; then
+    if ! echo "${AWS_BATCH_JOB_ID}" | aws s3 cp - s3://$AWS_BUCKET/${OUTPUT%/}/$OUTPUT_MARKER; then
+        log "Failed to write the output completion marker $OUTPUT_MARKER."
+        exit 1
+    fi
+fi
+
 # Delete output directory after copying to S3
 log "Deleting output files after successful copy to S3..."
 if ! rm -rf $TEMP_OUTPUT_PATH; then
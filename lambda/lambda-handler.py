@@ -1,11 +1,16 @@
 import boto3
 import json
+import math
 import os
 import logging
+import time
+import uuid
+from typing import NamedTuple, Optional, Tuple
 
-# Initialize AWS clients
-sqs_client = boto3.client('sqs')
-batch_client = boto3.client('batch')
+from botocore.exceptions import ClientError
+
+# AWS clients, created on first use and reused by later invocations of the same container
+_clients = {}
 
 # List of environment variable keys that are expected to be set
 ENV_KEYS = [
@@ -19,44 +24,497 @@ ENV_KEYS = [
     'QUEUE_URL'
 ]
 
+# Message keys with the types accepted for them
+MESSAGE_SCHEMA = {
+    'pipeline': str,
+    'input': str,
+    'output': str,
+    'job_definition': str,
+    'job_queue': str,
+    'job_memory': (str, int),
+    'job_vcpu': (str, int),
+    'output_mode': str,
+    'illum_pipeline': str,
+    'plate': str,
+    'plate_input': str,
+}
+REQUIRED_MESSAGE_KEYS = ('pipeline', 'input', 'output')
+OUTPUT_MODES = ('files', 'sharded')
+
+# A failed run whose peak memory reached this share of its requested memory was most likely
+# killed for running out of memory, so the next prediction doubles the memory it had
+OOM_PEAK_FRACTION = 0.9
+
+# Waiting jobs counted per AZ job queue when picking the least loaded one. Queues with more
+# waiting jobs count as equally loaded, which keeps the lookup to a few requests per queue.
+BACKLOG_SAMPLE_SIZE = 100
+
+# Claims on illumination caches share the profile table, under keys no profile uses
+ILLUM_CLAIM_KEY_PREFIX = 'illum#'
+ILLUM_CLAIM_SORT_KEY = 'claim'
+# A claim without a job ID after this many seconds belongs to an invocation that failed to submit it
+ILLUM_CLAIM_TIMEOUT = 60
+# Attempts at claiming or reading a claim, and the delay between reads of a claim without a job ID yet
+ILLUM_CLAIM_ATTEMPTS = 10
+ILLUM_CLAIM_POLL_SECONDS = 0.2
+# Written by the illumination job once all of its functions are uploaded, only then is the cache complete
+ILLUM_CACHE_MARKER = '_COMPLETE'
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
 
-def validate_env_vars():
+class Config(NamedTuple):
+    """
+    Lambda settings, parsed from the environment once per container.
+    """
+    job_name: str
+    job_definition: str
+    job_queue: str
+    job_queues: Tuple[str, ...]
+    retry_strategy: dict
+    job_memory: str
+    job_vcpus: str
+    bucket: str
+    queue_url: str
+    profile_table: Optional[str]
+    profile_history: int
+    profile_safety_margin: float
+    max_job_memory: Optional[int]
+    max_job_vcpus: Optional[int]
+    illum_cache_prefix: str
+
+
+_config = None
+
+
+def client(name):
+    """
+    Return the boto3 client for the service, creating it on first use.
+    """
+    if name not in _clients:
+        _clients[name] = boto3.client(name)
+    return _clients[name]
+
+
+def load_config():
+    """
+    Parse the environment into a Config, once per container.
+    Returns None when required environment variables are not set.
+    """
+    global _config
+    if _config is None:
+        missing = [key for key in ENV_KEYS if key not in os.environ]
+        if missing:
+            logging.error(f"Environment variables not set: {', '.join(missing)}")
+            return None
+
+        env = os.environ
+        _config = Config(
+            job_name=env['BATCH_JOB_NAME'],
+            job_definition=env['BATCH_JOB_DEFINITION'],
+            job_queue=env['BATCH_JOB_QUEUE'],
+            job_queues=tuple(queue for queue in env.get('BATCH_JOB_QUEUES', '').split(',') if queue),
+            retry_strategy={'attempts': int(env['BATCH_JOB_ATTEMPTS'])},
+            job_memory=env['BATCH_JOB_MEMORY'],
+            job_vcpus=env['BATCH_JOB_VCPUS'],
+            bucket=env['AWS_BUCKET'],
+            queue_url=env['QUEUE_URL'],
+            profile_table=env.get('PROFILE_TABLE'),
+            profile_history=int(env.get('PROFILE_HISTORY', 20)),
+            profile_safety_margin=float(env.get('PROFILE_SAFETY_MARGIN', 0.2)),
+            max_job_memory=int(env['MAX_JOB_MEMORY']) if env.get('MAX_JOB_MEMORY') else None,
+            max_job_vcpus=int(env['MAX_JOB_VCPUS']) if env.get('MAX_JOB_VCPUS') else None,
+            illum_cache_prefix=env.get('ILLUM_CACHE_PREFIX', 'illum-cache'),
+        )
+    return _config
+
+
+def validate_message(message):
+    """
+    Check a message against the message schema.
+    Returns a compact description of all problems found, or None when the message is valid.
+    """
+    if not isinstance(message, dict):
+        return f"expected an object, got {type(message).__name__}"
+
+    errors = [f"missing {key}" for key in REQUIRED_MESSAGE_KEYS if not message.get(key)]
+    for key, value in message.items():
+        types = MESSAGE_SCHEMA.get(key)
+        if types is None or value is None:
+            continue
+        if not isinstance(value, types):
+            errors.append(f"{key} must be a {'string' if types is str else 'number'}")
+        elif key in ('job_memory', 'job_vcpu') and not str(value).isdigit():
+            errors.append(f"{key} must be a whole number")
+    if message.get('output_mode', OUTPUT_MODES[0]) not in OUTPUT_MODES:
+        errors.append(f"output_mode must be one of {', '.join(OUTPUT_MODES)}")
+    # The illumination functions are cached per plate, so they are computed from all of its images
+    if 'illum_pipeline' in message and 'plate' in message and not message.get('plate_input'):
+        errors.append("plate requires plate_input")
+    return '; '.join(errors) or None
+
+
+def image_size_class(config, input_prefix):
+    """
+    Classify the images under the input prefix by their average size.
+    The class is the average object size rounded up to a power of two MB, e.g. '4MB'.
+    """
+    response = client('s3').list_objects_v2(
+        Bucket=config.bucket,
+        Prefix=input_prefix,
+        MaxKeys=100
+    )
+    sizes = [obj['Size'] for obj in response.get('Contents', [])]
+    if not sizes:
+        return 'empty'
+    average_mb = sum(sizes) / len(sizes) / (1024 * 1024)
+    return f"{2 ** max(0, math.ceil(math.log2(max(average_mb, 1))))}MB"
+
+
+def pipeline_hash(config, pipeline):
+    """
+    Return the hash of a pipeline file, its S3 ETag.
+    """
+    head = client('s3').head_object(Bucket=config.bucket, Key=pipeline)
+    return head['ETag'].strip('"')
+
+
+def profile_key(config, pipeline, input_prefix):
+    """
+    Build the profile store key from the pipeline hash and the image size class.
+    """
+    return f"{pipeline_hash(config, pipeline)}#{image_size_class(config, input_prefix)}"
+
+
+def predict_resources(config, key):
+    """
+    Predict memory (MB) and vCPUs for a job from the most recent runs recorded for the profile key.
+    The largest peak RSS and CPU use seen are scaled by the safety margin. Runs that failed
+    (non-zero exit status) close to their requested memory raise the memory to twice what they had.
+    The prediction is capped at the largest instance of the instance class.
+    Returns None when no runs have been recorded yet.
+    """
+    response = client('dynamodb').query(
+        TableName=config.profile_table,
+        KeyConditionExpression='profile_key = :key',
+        ExpressionAttributeValues={':key': {'S': key}},
+        ProjectionExpression='peak_rss_mb, cpu_used, requested_memory, exit_status',
+        ScanIndexForward=False,
+        Limit=config.profile_history
+    )
+    runs = response.get('Items', [])
+    if not runs:
+        return None
+
+    margin = 1 + config.profile_safety_margin
+    peak_rss_mb = max(float(run['peak_rss_mb']['N']) for run in runs)
+    cpu_used = max(float(run['cpu_used']['N']) for run in runs)
+    memory_mb = peak_rss_mb * margin
+
+    for run in runs:
+        failed = int(run.get('exit_status', {}).get('N', '0')) != 0
+        requested_mb = float(run.get('requested_memory', {}).get('N', '0'))
+        if failed and requested_mb and float(run['peak_rss_mb']['N']) >= OOM_PEAK_FRACTION * requested_mb:
+            memory_mb = max(memory_mb, 2 * requested_mb)
+
+    # Batch takes memory in MB, round up to the next 256 MB step
+    memory = math.ceil(memory_mb / 256) * 256
+    vcpus = max(1, math.ceil(cpu_used * margin))
+    if config.max_job_memory and memory > config.max_job_memory:
+        logging.warning(f"Predicted memory {memory} MB for profile {key} capped at {config.max_job_memory} MB")
+        memory = config.max_job_memory
+    if config.max_job_vcpus and vcpus > config.max_job_vcpus:
+        logging.warning(f"Predicted {vcpus} vCPUs for profile {key} capped at {config.max_job_vcpus} vCPUs")
+        vcpus = config.max_job_vcpus
+    return str(memory), str(vcpus)
+
+
+def job_profile(config, pipeline, input_prefix, profiles=None):
+    """
+    Return the profile key and the predicted resources (None without recorded runs) for a job.
+    profiles maps (pipeline, input prefix) to earlier results, so messages repeating them
+    don't look up the pipeline, the input listing and the profile store again.
+    """
+    if profiles is not None and (pipeline, input_prefix) in profiles:
+        return profiles[(pipeline, input_prefix)]
+
+    key = profile_key(config, pipeline, input_prefix)
+    profile = key, predict_resources(config, key)
+    if profiles is not None:
+        profiles[(pipeline, input_prefix)] = profile
+    return profile
+
+
+def queue_backlogs(config):
+    """
+    Count the jobs waiting in each AZ job queue of the multi-AZ layout, up to BACKLOG_SAMPLE_SIZE.
+    Returns None in the single-AZ layout.
+    """
+    if not config.job_queues:
+        return None
+
+    backlogs = {}
+    for job_queue in config.job_queues:
+        backlogs[job_queue] = 0
+        for status in ('SUBMITTED', 'PENDING', 'RUNNABLE'):
+            response = client('batch').list_jobs(
+                jobQueue=job_queue,
+                jobStatus=status,
+                maxResults=BACKLOG_SAMPLE_SIZE - backlogs[job_queue]
+            )
+            backlogs[job_queue] += len(response['jobSummaryList'])
+            if backlogs[job_queue] >= BACKLOG_SAMPLE_SIZE:
+                break
+    return backlogs
+
+
+def illumination_claim(config, cache):
+    """
+    Read the claim on an illumination cache.
+    Returns the claim ID, job ID ('' until recorded) and claim time, or None when the cache is unclaimed.
+    """
+    response = client('dynamodb').get_item(
+        TableName=config.profile_table,
+        Key={'profile_key': {'S': ILLUM_CLAIM_KEY_PREFIX + cache}, 'finished_at': {'S': ILLUM_CLAIM_SORT_KEY}},
+        ConsistentRead=True
+    )
+    item = response.get('Item')
+    if item is None:
+        return None
+    return item['claim_id']['S'], item.get('job_id', {}).get('S', ''), float(item['claimed_at']['N'])
+
+
+def claim_illumination(config, cache, stale_claim_id=None):
     """
-    Validate that all required environment variables are set.
+    Claim computing the functions into an illumination cache, with a conditional put in the profile table.
+    With stale_claim_id, take over that claim instead of requiring the cache to be unclaimed.
+    Returns the new claim ID, or None when another invocation holds the claim.
     """
-    for key in ENV_KEYS:
-        if key not in os.environ:
-            logging.error(f"Environment variable {key} not set")
-            return False
-    return True
+    claim_id = uuid.uuid4().hex
+    condition = {'ConditionExpression': 'attribute_not_exists(profile_key)'}
+    if stale_claim_id:
+        condition = {
+            'ConditionExpression': 'claim_id = :claim_id',
+            'ExpressionAttributeValues': {':claim_id': {'S': stale_claim_id}},
+        }
+    try:
+        client('dynamodb').put_item(
+            TableName=config.profile_table,
+            Item={
+                'profile_key': {'S': ILLUM_CLAIM_KEY_PREFIX + cache},
+                'finished_at': {'S': ILLUM_CLAIM_SORT_KEY},
+                'claim_id': {'S': claim_id},
+                'claimed_at': {'N': str(time.time())},
+            },
+            **condition
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
+        raise
+    return claim_id
+
+
+def record_illumination_job(config, cache, claim_id, job_id):
+    """
+    Record the ID of the job computing an illumination cache in the claim on it.
+    """
+    client('dynamodb').update_item(
+        TableName=config.profile_table,
+        Key={'profile_key': {'S': ILLUM_CLAIM_KEY_PREFIX + cache}, 'finished_at': {'S': ILLUM_CLAIM_SORT_KEY}},
+        UpdateExpression='SET job_id = :job_id',
+        ConditionExpression='claim_id = :claim_id',
+        ExpressionAttributeValues={':job_id': {'S': job_id}, ':claim_id': {'S': claim_id}}
+    )
+
+
+def release_illumination_claim(config, cache, claim_id):
+    """
+    Remove a claim on an illumination cache, unless another invocation has taken it over.
+    """
+    try:
+        client('dynamodb').delete_item(
+            TableName=config.profile_table,
+            Key={'profile_key': {'S': ILLUM_CLAIM_KEY_PREFIX + cache}, 'finished_at': {'S': ILLUM_CLAIM_SORT_KEY}},
+            ConditionExpression='claim_id = :claim_id',
+            ExpressionAttributeValues={':claim_id': {'S': claim_id}}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+def job_status(job_id):
+    """
+    Return the status of a job, or None when it is no longer known to AWS Batch.
+    """
+    jobs = client('batch').describe_jobs(jobs=[job_id])['jobs']
+    return jobs[0]['status'] if jobs else None
+
+
+def illumination_cached(config, cache):
+    """
+    Check whether the illumination cache is complete, i.e. its job wrote the completion marker.
+    """
+    response = client('s3').list_objects_v2(Bucket=config.bucket, Prefix=cache + ILLUM_CACHE_MARKER, MaxKeys=1)
+    return bool(response.get('Contents'))
+
+
+def submit_illumination_job(config, message, cache, backlogs=None, profiles=None):
+    """
+    Submit a job computing the illumination functions of the message's plate into the cache.
+    """
+    illum_message = {key: message[key] for key in ('job_definition', 'job_queue') if key in message}
+    illum_message.update(
+        pipeline=message['illum_pipeline'],
+        input=message.get('plate_input', message['input']),
+        output=cache,
+        # The analysis jobs look for the .npy files themselves, they can't be packed into shards
+        output_mode='files',
+        output_marker=ILLUM_CACHE_MARKER
+    )
+    job_id = submit_job_to_batch(config, illum_message, backlogs, profiles=profiles)
+    logging.info(f"Computing illumination functions into {cache} with job {job_id}")
+    return job_id
+
+
+def illumination_job(config, message, cache, backlogs=None, profiles=None):
+    """
+    Return the ID of the job computing the illumination functions into the cache, or None when
+    the claimed job has completed the cache in the meantime.
+    The job is submitted by the invocation holding the claim on the cache, so a plate spread over
+    many invocations gets a single job. Claims whose job failed or finished without completing the
+    cache, or whose invocation never recorded its job, are taken over.
+    Raises RuntimeError when another invocation's claim doesn't get a job ID in time.
+    """
+    if not config.profile_table:
+        return submit_illumination_job(config, message, cache, backlogs, profiles)
+
+    stale_claim_id = None
+    for _ in range(ILLUM_CLAIM_ATTEMPTS):
+        claim_id = claim_illumination(config, cache, stale_claim_id)
+        if claim_id:
+            try:
+                job_id = submit_illumination_job(config, message, cache, backlogs, profiles)
+            except Exception:
+                # Let the next invocation claim the cache instead of waiting for a job that doesn't exist
+                release_illumination_claim(config, cache, claim_id)
+                raise
+            record_illumination_job(config, cache, claim_id, job_id)
+            return job_id
+
+        claim = illumination_claim(config, cache)
+        if claim is None:
+            stale_claim_id = None
+            continue
+        claim_id, job_id, claimed_at = claim
+        if job_id:
+            status = job_status(job_id)
+            if status not in (None, 'FAILED', 'SUCCEEDED'):
+                logging.info(f"Waiting for illumination functions computed into {cache} by job {job_id}")
+                return job_id
+            if status == 'SUCCEEDED' and illumination_cached(config, cache):
+                return None
+            # The job failed, is gone, or succeeded without completing the cache
+            stale_claim_id = claim_id
+        elif time.time() - claimed_at > ILLUM_CLAIM_TIMEOUT:
+            stale_claim_id = claim_id
+        else:
+            # The claiming invocation is still submitting its job
+            stale_claim_id = None
+            time.sleep(ILLUM_CLAIM_POLL_SECONDS)
 
+    raise RuntimeError(f"Timed out waiting for the illumination job claimed for {cache}")
 
-def submit_job_to_batch(message):
+
+def illumination_functions(config, message, backlogs=None, illum_jobs=None, profiles=None):
+    """
+    Locate the illumination correction functions for the message's plate in the bucket cache,
+    keyed by plate and illumination pipeline hash. When they aren't cached yet, find or submit
+    the job computing them into the cache.
+    Returns the cache prefix and the ID of the job computing it (None when already cached).
+    illum_jobs maps cache prefixes to job IDs, so messages of the same invocation skip the lookups.
+    """
+    plate = message.get('plate', message['input'].strip('/'))
+    cache = f"{config.illum_cache_prefix}/{plate}/{pipeline_hash(config, message['illum_pipeline'])}/"
+    if illum_jobs is not None and cache in illum_jobs:
+        return cache, illum_jobs[cache]
+
+    job_id = None
+    if not illumination_cached(config, cache):
+        job_id = illumination_job(config, message, cache, backlogs, profiles)
+    if job_id is None:
+        logging.info(f"Using cached illumination functions: {cache}")
+
+    if illum_jobs is not None:
+        illum_jobs[cache] = job_id
+    return cache, job_id
+
+
+def submit_job_to_batch(config, message, backlogs=None, illum_jobs=None, profiles=None):
     """
-    Submit a job to AWS Batch using message content as parameters.
+    Submit a job to AWS Batch using message content as parameters and return its job ID.
+    The message must have passed validate_message.
+    In the multi-AZ layout the job goes to the AZ queue with the smallest backlog.
+    Messages with an 'illum_pipeline' depend on the job precomputing the plate's illumination functions.
     """
-    job_name = os.environ['BATCH_JOB_NAME']
-    job_attempts = int(os.environ['BATCH_JOB_ATTEMPTS'])
     pipeline = message['pipeline']
     input = message['input']
     output = message['output']
 
-    job_definition = message.get('job_definition', os.environ['BATCH_JOB_DEFINITION'])
-    job_queue = message.get('job_queue', os.environ['BATCH_JOB_QUEUE'])
+    job_definition = message.get('job_definition', config.job_definition)
+    job_queue = config.job_queue
+    if backlogs:
+        job_queue = min(backlogs, key=backlogs.get)
+    job_queue = message.get('job_queue', job_queue)
+
+    environment = [
+        {'name': 'INPUT', 'value': input},
+        {'name': 'OUTPUT', 'value': output},
+        {'name': 'PIPELINE', 'value': pipeline},
+    ]
+
+    # Right-size the job from the profile store when the message doesn't set the resources
+    memory = config.job_memory
+    vcpus = config.job_vcpus
+    if config.profile_table:
+        try:
+            key, predicted = job_profile(config, pipeline, input, profiles)
+            if predicted:
+                memory, vcpus = predicted
+                logging.info(f"Predicted resources for profile {key}: {memory} MB, {vcpus} vCPUs")
+            else:
+                logging.info(f"No recorded runs for profile {key}, using default resources")
+            environment.append({'name': 'PROFILE_KEY', 'value': key})
+        except Exception as e:
+            logging.warning(f"Failed to predict job resources, using default resources: {e}")
 
     # Check for optional parameters in the message
-    memory = message.get('job_memory', os.environ.get('BATCH_JOB_MEMORY'))
-    vcpus = message.get('job_vcpu', os.environ.get('BATCH_JOB_VCPUS'))
+    memory = str(message.get('job_memory', memory))
+    vcpus = str(message.get('job_vcpu', vcpus))
+
+    # The worker records these next to the measured values in the profile store
+    environment.append({'name': 'REQUESTED_MEMORY', 'value': memory})
+    environment.append({'name': 'REQUESTED_VCPUS', 'value': vcpus})
+
+    # Load the precomputed illumination functions, waiting for the job computing them if needed
+    depends_on = []
+    if 'illum_pipeline' in message:
+        illum_input, illum_job_id = illumination_functions(config, message, backlogs, illum_jobs, profiles)
+        environment.append({'name': 'ILLUM_INPUT', 'value': illum_input})
+        if illum_job_id:
+            depends_on.append({'jobId': illum_job_id})
+
+    # Optional output mode ('files' or 'sharded'), defaults to the job definition setting
+    if 'output_mode' in message:
+        environment.append({'name': 'OUTPUT_MODE', 'value': message['output_mode']})
+    # Set by the Lambda for jobs whose output is only complete once the marker is written
+    if 'output_marker' in message:
+        environment.append({'name': 'OUTPUT_MARKER', 'value': message['output_marker']})
 
     container_overrides = {
-        'environment': [
-            {'name': 'INPUT', 'value': input},
-            {'name': 'OUTPUT', 'value': output},
-            {'name': 'PIPELINE', 'value': pipeline},
-        ],
+        'environment': environment,
         "resourceRequirements": [
             {
                 "type": "MEMORY",
@@ -66,32 +524,31 @@ def submit_job_to_batch(message):
                 "type": "VCPU",
                 "value": vcpus
             }
-        ],        
+        ],
     }
 
-    # if memory and vcpus:
-    #     container_overrides['memory'] = memory
-    #     container_overrides['vcpus'] = vcpus
-
-    response = batch_client.submit_job(
-        jobName=job_name,
+    response = client('batch').submit_job(
+        jobName=config.job_name,
         jobDefinition=job_definition,
         jobQueue=job_queue,
         containerOverrides=container_overrides,
-        retryStrategy={
-            'attempts': job_attempts
-        }
+        dependsOn=depends_on,
+        retryStrategy=config.retry_strategy
     )
-    logging.info(f"Job submitted: {response}")
+    logging.info(f"Job submitted: {response['jobId']}")
+
+    if backlogs and job_queue in backlogs:
+        backlogs[job_queue] += 1
+    return response['jobId']
 
 
-def delete_message_from_sqs(record):
+def delete_message_from_sqs(config, record):
     """
     Delete the processed message from the SQS queue.
     """
     receipt_handle = record['receiptHandle']
-    sqs_client.delete_message(
-        QueueUrl=os.environ['QUEUE_URL'],
+    client('sqs').delete_message(
+        QueueUrl=config.queue_url,
         ReceiptHandle=receipt_handle
     )
 
@@ -99,36 +556,63 @@ def delete_message_from_sqs(record):
 def handler(event, context):
     """
     Lambda function entry point.
+    Records whose illumination functions couldn't be located or submitted are reported as batch item
+    failures, so SQS delivers them again once the visibility timeout expires.
     """
-    if not validate_env_vars():
+    config = load_config()
+    if config is None:
         logging.error("Required environment variables are not set.")
         return
 
+    try:
+        backlogs = queue_backlogs(config)
+    except Exception as e:
+        logging.warning(f"Failed to read the job queue backlogs, using the default job queue: {e}")
+        backlogs = None
+
+    # Illumination function jobs submitted during this invocation, by cache prefix
+    illum_jobs = {}
+    # Profile keys and predicted resources looked up during this invocation, by pipeline and input
+    profiles = {}
+    failures = []
+
     for record in event['Records']:
         try:
             parsed_data = json.loads(record['body'])
+        except json.JSONDecodeError as e:
+            logging.error(f"Failed to parse message: {e}")
+            continue
 
-            # If the parsed data is a list, iterate over each message
-            if isinstance(parsed_data, list):
-                for message in parsed_data:
-                    try:
-                        submit_job_to_batch(message)
-                    except Exception as e:
-                        logging.error(f"Failed to submit job: {e}")
-            # If the parsed data is a dictionary, process it directly
-            elif isinstance(parsed_data, dict):
-                try:
-                    submit_job_to_batch(parsed_data)
-                except Exception as e:
-                    logging.error(f"Failed to submit job: {e}")
+        # A message body holds a single job or a list of jobs
+        messages = parsed_data if isinstance(parsed_data, list) else [parsed_data]
+        valid_messages = []
+        for i, message in enumerate(messages):
+            error = validate_message(message)
+            if error:
+                logging.error(f"Invalid message {record.get('messageId', '')}[{i}]: {error}")
             else:
-                logging.error(f"Unexpected message format: {parsed_data}")
+                valid_messages.append(message)
 
-        except json.JSONDecodeError as e:
-            logging.error(f"Failed to parse message: {e}")
+        # Locate the illumination jobs before submitting any job of the record, so a record that is
+        # retried because another invocation's claim is still pending doesn't submit its jobs twice
+        try:
+            for message in valid_messages:
+                if 'illum_pipeline' in message:
+                    illumination_functions(config, message, backlogs, illum_jobs, profiles)
+        except Exception as e:
+            logging.error(f"Failed to locate illumination functions, retrying message {record['messageId']}: {e}")
+            failures.append({'itemIdentifier': record['messageId']})
             continue
 
+        for message in valid_messages:
+            try:
+                submit_job_to_batch(config, message, backlogs, illum_jobs, profiles)
+            except Exception as e:
+                logging.error(f"Failed to submit job: {e}")
+
         try:
-            delete_message_from_sqs(record)
+            delete_message_from_sqs(config, record)
         except Exception as e:
             logging.error(f"Failed to delete message from SQS: {e}")
+
+    return {'batchItemFailures': failures}
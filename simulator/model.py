@@ -0,0 +1,308 @@
+"""
+Discrete-event model of the CPB pipeline: SQS -> Lambda -> Batch -> instance boot -> FSx/S3.
+
+The model replays a submission trace against a candidate configuration and reports the
+makespan, vCPU utilisation and cost per plate. It takes the same keys as DEV_CONFIG in
+constants.py, so `simulate(trace, constants.DEV_CONFIG)` models the deployed settings.
+Keys starting with SIM_ describe service behaviour that the stack doesn't configure.
+"""
+import heapq
+import itertools
+import math
+from collections import deque
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+# Instance sizes per class: (size, vCPUs, memory GiB, on-demand USD per hour in us-east-1)
+INSTANCE_TYPES = {
+    "c4": [("large", 2, 3.75, 0.100), ("xlarge", 4, 7.5, 0.199), ("2xlarge", 8, 15, 0.398),
+           ("4xlarge", 16, 30, 0.796), ("8xlarge", 36, 60, 1.591)],
+    "c5": [("large", 2, 4, 0.085), ("xlarge", 4, 8, 0.170), ("2xlarge", 8, 16, 0.340),
+           ("4xlarge", 16, 32, 0.680), ("9xlarge", 36, 72, 1.530), ("18xlarge", 72, 144, 3.060)],
+    "m5": [("large", 2, 8, 0.096), ("xlarge", 4, 16, 0.192), ("2xlarge", 8, 32, 0.384),
+           ("4xlarge", 16, 64, 0.768), ("12xlarge", 48, 192, 2.304), ("24xlarge", 96, 384, 4.608)],
+    "r5": [("large", 2, 16, 0.126), ("xlarge", 4, 32, 0.252), ("2xlarge", 8, 64, 0.504),
+           ("4xlarge", 16, 128, 1.008), ("12xlarge", 48, 384, 3.024), ("24xlarge", 96, 768, 6.048)],
+}
+
+# FSx for Lustre PERSISTENT_1 USD per GB-month, by throughput per TiB
+FSX_PRICE_PER_GB_MONTH = {50: 0.145, 100: 0.210, 200: 0.290}
+
+DEFAULT_CONFIG = {
+    "COMPUTE_MIN_CPU": 0,
+    "COMPUTE_MAX_CPU": 500,
+    "INSTANCE_CLASS": "c4",
+    "JOB_CPU": 4,
+    "JOB_MEMORY": 4096,
+    "JOB_ATTEMPTS": 3,
+    "JOB_TIMEOUT": 1500,
+    "SQS_MESSAGE_VISIBILITY": 1200,
+    "FSX_STORAGE_CAPACITY": 1200,
+    "FSX_THROUGHPUT_PER_TIB": 50,
+    # Seconds between a message arriving on the queue and the Lambda picking it up
+    "SIM_LAMBDA_POLL_LATENCY": 1.0,
+    # Seconds the Lambda spends per submitted job
+    "SIM_LAMBDA_SUBMIT_LATENCY": 0.08,
+    # Seconds between a job being submitted and becoming RUNNABLE
+    "SIM_DISPATCH_LATENCY": 20.0,
+    # Seconds from instance launch until it accepts jobs, including the Lustre client and mount
+    "SIM_INSTANCE_BOOT_TIME": 240.0,
+    # Seconds an idle instance is kept before Batch scales it in
+    "SIM_INSTANCE_IDLE_TIMEOUT": 300.0,
+    # Seconds to start a container on a booted instance
+    "SIM_CONTAINER_START_TIME": 30.0,
+    # Share of instance memory available to containers after the ECS agent and OS
+    "SIM_INSTANCE_MEMORY_AVAILABLE": 0.94,
+}
+
+
+@dataclass
+class Job:
+    """
+    A single CellProfiler run. cpu_seconds is the compute time on one vCPU,
+    threads the number of vCPUs the run can keep busy.
+    """
+    plate: str
+    cpu_seconds: float
+    input_mb: float = 0.0
+    peak_memory_mb: float = 0.0
+    threads: int = 1
+
+
+@dataclass
+class Message:
+    """
+    An SQS message sent at submitted_at seconds, carrying one or more jobs.
+    """
+    submitted_at: float
+    jobs: List[Job]
+
+
+@dataclass
+class SimulationResult:
+    makespan: float
+    utilisation: float
+    allocation: float
+    cost: float
+    cost_per_plate: float
+    mean_wait: float
+    completed_jobs: int
+    failed_jobs: int
+    duplicate_jobs: int
+    peak_vcpus: int
+    config: dict = field(default_factory=dict, repr=False)
+
+
+class _Instance:
+    __slots__ = ("vcpus", "memory_mb", "price", "free_vcpus", "free_memory_mb",
+                 "launched_at", "ready", "running", "idle_since", "terminated_at")
+
+    def __init__(self, vcpus, memory_mb, price, launched_at):
+        self.vcpus = vcpus
+        self.memory_mb = memory_mb
+        self.price = price
+        self.free_vcpus = vcpus
+        self.free_memory_mb = memory_mb
+        self.launched_at = launched_at
+        self.ready = False
+        self.running = 0
+        self.idle_since = launched_at
+        self.terminated_at = None
+
+
+def instance_class_name(instance_class):
+    """
+    Return the instance class name for a string or an ec2.InstanceClass value, e.g. 'c4'.
+    """
+    return str(getattr(instance_class, "value", instance_class)).lower()
+
+
+def simulate(trace: List[Message], config: Optional[dict] = None) -> SimulationResult:
+    """
+    Replay the trace against the configuration and return the resulting metrics.
+    """
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    job_cpu = config["JOB_CPU"]
+    job_memory = config["JOB_MEMORY"]
+    max_cpu = config["COMPUTE_MAX_CPU"]
+    idle_timeout = config["SIM_INSTANCE_IDLE_TIMEOUT"]
+    container_start = config["SIM_CONTAINER_START_TIME"]
+    memory_available = config["SIM_INSTANCE_MEMORY_AVAILABLE"]
+    fsx_throughput = config["FSX_THROUGHPUT_PER_TIB"] * config["FSX_STORAGE_CAPACITY"] / 1024
+
+    # Instance sizes able to hold a single job, smallest first
+    sizes = [(vcpus, memory * 1024 * memory_available, price)
+             for _, vcpus, memory, price in INSTANCE_TYPES[instance_class_name(config["INSTANCE_CLASS"])]
+             if vcpus >= job_cpu and memory * 1024 * memory_available >= job_memory]
+
+    def slots(vcpus, memory_mb):
+        # Jobs an instance holds, limited by whichever of vCPUs and memory runs out first
+        return min(vcpus // job_cpu, int(memory_mb // job_memory))
+
+    events = []
+    sequence = itertools.count()
+
+    def push(time, kind, payload=None):
+        heapq.heappush(events, (time, next(sequence), kind, payload))
+
+    instances = []
+    # Ready instances with room for another job, an insertion ordered dict used as a set
+    available = {}
+    runnable = deque()
+    state = {"vcpus": 0, "booting_slots": 0, "peak_vcpus": 0, "running_jobs": 0}
+    totals = {"reserved": 0.0, "used": 0.0, "wait": 0.0, "started": 0,
+              "completed": 0, "failed": 0, "duplicates": 0, "last_finish": 0.0}
+
+    def launch(now, vcpus, memory_mb, price, ready=False):
+        instance = _Instance(vcpus, memory_mb, price, now)
+        instances.append(instance)
+        state["vcpus"] += vcpus
+        state["peak_vcpus"] = max(state["peak_vcpus"], state["vcpus"])
+        if ready:
+            instance.ready = True
+            available[instance] = None
+        else:
+            state["booting_slots"] += slots(vcpus, memory_mb)
+            push(now + config["SIM_INSTANCE_BOOT_TIME"], "ready", instance)
+
+    def start(now, instance, job, attempt, runnable_at):
+        instance.free_vcpus -= job_cpu
+        instance.free_memory_mb -= job_memory
+        instance.running += 1
+        if instance.free_vcpus < job_cpu or instance.free_memory_mb < job_memory:
+            del available[instance]
+        state["running_jobs"] += 1
+        totals["wait"] += now - runnable_at
+        totals["started"] += 1
+
+        # Jobs starting together share the FSx throughput while reading their input
+        cores = min(job_cpu, job.threads)
+        compute = job.cpu_seconds / cores
+        io = job.input_mb / (fsx_throughput / state["running_jobs"]) if fsx_throughput else 0.0
+        duration = container_start + compute + io
+        succeeded = True
+        if job.peak_memory_mb > job_memory:
+            # Out of memory part way through the run
+            duration = container_start + compute / 2
+            succeeded = False
+        elif duration > config["JOB_TIMEOUT"]:
+            duration = config["JOB_TIMEOUT"]
+            succeeded = False
+        totals["reserved"] += job_cpu * duration
+        totals["used"] += cores * max(0.0, duration - container_start - io)
+        push(now + duration, "finish", (instance, job, attempt, succeeded))
+
+    def schedule(now):
+        # Best fit: place each job on the ready instance left with the fewest free vCPUs
+        while runnable and available:
+            best = min(available, key=lambda instance: instance.free_vcpus)
+            job, attempt, runnable_at = runnable.popleft()
+            start(now, best, job, attempt, runnable_at)
+
+        # Scale out for the jobs that still don't fit, counting the jobs instances already booting will hold
+        demand = len(runnable) - state["booting_slots"]
+        while demand > 0 and sizes:
+            fitting = [size for size in sizes if state["vcpus"] + size[0] <= max_cpu]
+            if not fitting:
+                break
+            size = next((size for size in fitting if slots(*size[:2]) >= demand), fitting[-1])
+            launch(now, *size)
+            demand -= slots(*size[:2])
+
+    def idle_check(now, instance):
+        if instance.running == 0 and instance.terminated_at is None:
+            instance.idle_since = now
+            push(now + idle_timeout, "idle", (instance, now))
+
+    # Capacity kept warm by COMPUTE_MIN_CPU
+    if sizes:
+        warm = 0
+        while warm < config["COMPUTE_MIN_CPU"]:
+            launch(0.0, *sizes[-1], ready=True)
+            warm += sizes[-1][0]
+    min_cpu = state["vcpus"]
+
+    for message in trace:
+        push(message.submitted_at + config["SIM_LAMBDA_POLL_LATENCY"], "message", message)
+
+    now = 0.0
+    first_submission = min((message.submitted_at for message in trace), default=0.0)
+    while events:
+        now, _, kind, payload = heapq.heappop(events)
+
+        if kind == "message":
+            # Messages still being processed after the visibility timeout are delivered again
+            latency = config["SIM_LAMBDA_SUBMIT_LATENCY"]
+            processing = len(payload.jobs) * latency
+            deliveries = max(1, math.ceil(processing / config["SQS_MESSAGE_VISIBILITY"]))
+            totals["duplicates"] += (deliveries - 1) * len(payload.jobs)
+            for delivery in range(deliveries):
+                offset = delivery * config["SQS_MESSAGE_VISIBILITY"]
+                for i, job in enumerate(payload.jobs):
+                    push(now + offset + (i + 1) * latency + config["SIM_DISPATCH_LATENCY"], "runnable", job)
+
+        elif kind == "runnable":
+            if not sizes:
+                # No instance in the class can hold JOB_CPU and JOB_MEMORY
+                totals["failed"] += 1
+                continue
+            runnable.append((payload, 1, now))
+            schedule(now)
+
+        elif kind == "ready":
+            payload.ready = True
+            available[payload] = None
+            state["booting_slots"] -= slots(payload.vcpus, payload.memory_mb)
+            idle_check(now, payload)
+            schedule(now)
+
+        elif kind == "finish":
+            instance, job, attempt, succeeded = payload
+            instance.free_vcpus += job_cpu
+            instance.free_memory_mb += job_memory
+            instance.running -= 1
+            available[instance] = None
+            state["running_jobs"] -= 1
+            totals["last_finish"] = now
+            if succeeded:
+                totals["completed"] += 1
+            elif attempt < config["JOB_ATTEMPTS"]:
+                runnable.append((job, attempt + 1, now))
+            else:
+                totals["failed"] += 1
+            schedule(now)
+            idle_check(now, instance)
+
+        elif kind == "idle":
+            instance, idle_since = payload
+            if (instance.running == 0 and instance.idle_since == idle_since
+                    and instance.terminated_at is None and state["vcpus"] - instance.vcpus >= min_cpu):
+                instance.terminated_at = now
+                del available[instance]
+                state["vcpus"] -= instance.vcpus
+
+    end = max(now, totals["last_finish"])
+    makespan = totals["last_finish"] - first_submission
+    provisioned = 0.0
+    cost = 0.0
+    for instance in instances:
+        terminated_at = instance.terminated_at if instance.terminated_at is not None else end
+        provisioned += instance.vcpus * (terminated_at - instance.launched_at)
+        cost += instance.price * (terminated_at - instance.launched_at) / 3600
+    fsx_price = FSX_PRICE_PER_GB_MONTH.get(config["FSX_THROUGHPUT_PER_TIB"], FSX_PRICE_PER_GB_MONTH[50])
+    cost += config["FSX_STORAGE_CAPACITY"] * fsx_price / 730 * makespan / 3600
+
+    plates = {job.plate for message in trace for job in message.jobs}
+    return SimulationResult(
+        makespan=makespan,
+        utilisation=totals["used"] / provisioned if provisioned else 0.0,
+        allocation=totals["reserved"] / provisioned if provisioned else 0.0,
+        cost=cost,
+        cost_per_plate=cost / len(plates) if plates else 0.0,
+        mean_wait=totals["wait"] / totals["started"] if totals["started"] else 0.0,
+        completed_jobs=totals["completed"],
+        failed_jobs=totals["failed"],
+        duplicate_jobs=totals["duplicates"],
+        peak_vcpus=state["peak_vcpus"],
+        config=config,
+    )
@@ -0,0 +1,91 @@
+"""
+Sweep candidate configurations over a submission trace and rank them.
+
+    python -m simulator.sweep --plates 20 --set COMPUTE_MAX_CPU=100,250,500 --set JOB_CPU=1,2,4 \
+        --set INSTANCE_CLASS=c4,c5 --sort cost_per_plate
+"""
+import argparse
+import itertools
+import sys
+
+from simulator.model import DEFAULT_CONFIG, INSTANCE_TYPES, instance_class_name, simulate
+from simulator.trace import load_trace, synthetic_trace
+
+COLUMNS = ["makespan", "utilisation", "allocation", "cost_per_plate", "mean_wait", "failed_jobs", "peak_vcpus"]
+
+
+def parse_value(value):
+    """
+    Parse a command line value as an int, a float or a string.
+    """
+    for parse in (int, float):
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+    return value
+
+
+def sweep(trace, grid, base=None):
+    """
+    Simulate the trace for every combination of the values in grid, a dict of config key to
+    candidate values, applied on top of the base config. Return the results in grid order.
+    """
+    base = dict(DEFAULT_CONFIG, **(base or {}))
+    keys = list(grid)
+    return [simulate(trace, dict(base, **dict(zip(keys, values))))
+            for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep CPB configurations over a submission trace.")
+    parser.add_argument("--trace", help="Recorded trace (JSON lines), a synthetic trace is used when omitted")
+    parser.add_argument("--plates", type=int, default=10, help="Synthetic trace: number of plates")
+    parser.add_argument("--jobs-per-plate", type=int, default=96, help="Synthetic trace: jobs per plate")
+    parser.add_argument("--plate-interval", type=float, default=60.0, help="Synthetic trace: seconds between plates")
+    parser.add_argument("--cpu-seconds", type=float, default=600.0, help="Synthetic trace: job CPU seconds")
+    parser.add_argument("--input-mb", type=float, default=400.0, help="Synthetic trace: job input size in MB")
+    parser.add_argument("--peak-memory-mb", type=float, default=2500.0, help="Synthetic trace: job peak memory in MB")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=V1,V2",
+                        help="Candidate values for a config key, repeat for several keys")
+    parser.add_argument("--sort", default="makespan", choices=COLUMNS, help="Column to rank the results by")
+    parser.add_argument("--top", type=int, default=20, help="Number of results to print")
+    args = parser.parse_args(argv)
+
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = synthetic_trace(
+            plates=args.plates,
+            jobs_per_plate=args.jobs_per_plate,
+            plate_interval=args.plate_interval,
+            cpu_seconds=args.cpu_seconds,
+            input_mb=args.input_mb,
+            peak_memory_mb=args.peak_memory_mb,
+        )
+
+    grid = {}
+    for setting in args.set:
+        key, _, values = setting.partition("=")
+        if key not in DEFAULT_CONFIG:
+            parser.error(f"Unknown config key: {key}")
+        grid[key] = [parse_value(value) for value in values.split(",")]
+    for instance_class in grid.get("INSTANCE_CLASS", []):
+        if instance_class_name(instance_class) not in INSTANCE_TYPES:
+            parser.error(f"Unknown instance class: {instance_class} (choose from {', '.join(INSTANCE_TYPES)})")
+
+    results = sweep(trace, grid)
+    # Higher utilisation ranks first, configurations failing jobs rank last
+    sign = -1 if args.sort in ("utilisation", "allocation") else 1
+    results.sort(key=lambda result: (result.failed_jobs > 0, sign * getattr(result, args.sort)))
+
+    header = list(grid) + COLUMNS
+    print("  ".join(f"{column:>14}" for column in header))
+    for result in results[:args.top]:
+        row = [result.config[key] for key in grid] + [getattr(result, column) for column in COLUMNS]
+        print("  ".join(f"{value:>14.3f}" if isinstance(value, float) else f"{value!s:>14}" for value in row))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""
+Submission traces for the simulator, either recorded or synthetic.
+
+A recorded trace is a JSON lines file. Each line holds the time the message was sent
+in seconds and the message body as sent to the SQS queue, a job or a list of jobs:
+
+    {"submitted_at": 0, "body": [{"plate": "plate1", "cpu_seconds": 600, "input_mb": 400, "peak_memory_mb": 2500}]}
+
+The job keys follow the SQS message format. `plate` defaults to the job's `input`, and
+`cpu_seconds`, `input_mb`, `peak_memory_mb` and `threads` describe the measured run,
+e.g. from the run profile table.
+"""
+import json
+import random
+
+from simulator.model import Job, Message
+
+
+def job_from_body(body):
+    """
+    Build a Job from a single job of an SQS message body.
+    """
+    return Job(
+        plate=body.get("plate", body.get("input", "")),
+        cpu_seconds=float(body["cpu_seconds"]),
+        input_mb=float(body.get("input_mb", 0)),
+        peak_memory_mb=float(body.get("peak_memory_mb", 0)),
+        threads=int(body.get("threads", 1)),
+    )
+
+
+def load_trace(path):
+    """
+    Load a recorded trace from a JSON lines file.
+    """
+    trace = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            body = record["body"]
+            jobs = body if isinstance(body, list) else [body]
+            trace.append(Message(float(record["submitted_at"]), [job_from_body(job) for job in jobs]))
+    return trace
+
+
+def synthetic_trace(plates=10, jobs_per_plate=96, plate_interval=60.0, cpu_seconds=600.0,
+                    input_mb=400.0, peak_memory_mb=2500.0, threads=1, jitter=0.25, seed=0):
+    """
+    Generate a trace where one message per plate, carrying all of the plate's jobs,
+    is sent every plate_interval seconds. Job run time, input size and peak memory
+    vary uniformly by +/- jitter around the given values.
+    """
+    rng = random.Random(seed)
+
+    def vary(value):
+        return value * rng.uniform(1 - jitter, 1 + jitter)
+
+    return [
+        Message(plate * plate_interval, [
+            Job(f"plate{plate}", vary(cpu_seconds), vary(input_mb), vary(peak_memory_mb), threads)
+            for _ in range(jobs_per_plate)
+        ])
+        for plate in range(plates)
+    ]
@@ -14,12 +14,15 @@ from aws_cdk import (
     aws_ecr_assets as ecra,
     aws_fsx as fsx,
     aws_ecs as ecs,
+    aws_dynamodb as dynamodb,
     
   
 )
 from constructs import Construct
 import aws_cdk as core
 
+from simulator.model import DEFAULT_CONFIG as SIMULATOR_CONFIG, INSTANCE_TYPES, instance_class_name
+
 # The BatchStack class is where we define our AWS Batch environment, including associated resources such as an S3 bucket, an SQS queue, and a Lambda function.
 
 class BatchStack(Stack):
@@ -43,12 +46,24 @@ class BatchStack(Stack):
         COMPUTE_BID_PERCENT  = config["COMPUTE_BID_PERCENT"]
         INSTANCE_CLASS = config["INSTANCE_CLASS"]
         EBS_VOL_SIZE  = config["EBS_VOL_SIZE"]
+        INPUT_CACHE_SIZE  = config["INPUT_CACHE_SIZE"]
+        INPUT_CACHE_METRICS_NAMESPACE  = config["INPUT_CACHE_METRICS_NAMESPACE"]
+        FSX_STORAGE_CAPACITY  = config["FSX_STORAGE_CAPACITY"]
+        FSX_THROUGHPUT_PER_TIB  = config["FSX_THROUGHPUT_PER_TIB"]
         JOB_CPU  = config["JOB_CPU"]
         JOB_MEMORY  = config["JOB_MEMORY"]
         JOB_ATTEMPTS  = config["JOB_ATTEMPTS"]
         JOB_TIMEOUT  = config["JOB_TIMEOUT"]
         SQS_MESSAGE_VISIBILITY  = config["SQS_MESSAGE_VISIBILITY"]
+        LAMBDA_TIMEOUT  = config["LAMBDA_TIMEOUT"]
+        MULTI_AZ  = config["MULTI_AZ"]
+        PROFILE_SAFETY_MARGIN  = config["PROFILE_SAFETY_MARGIN"]
+        PROFILE_HISTORY  = config["PROFILE_HISTORY"]
+        ILLUM_CACHE_PREFIX  = config["ILLUM_CACHE_PREFIX"]
         REQUIREMENTS_FILE  = config["REQUIREMENTS_FILE"]
+        OUTPUT_MODE  = config["OUTPUT_MODE"]
+        OUTPUT_SHARD_SIZE_MB  = config["OUTPUT_SHARD_SIZE_MB"]
+        OUTPUT_SMALL_FILE_MB  = config["OUTPUT_SMALL_FILE_MB"]
         # Get the current account number  
         current_account = core.Aws.ACCOUNT_ID
  
@@ -114,6 +129,22 @@ class BatchStack(Stack):
 
   
     
+        # Create the run profile table. Each finished job records its peak memory and CPU use
+        # under a key built from the pipeline hash and image size class.
+        profile_table = dynamodb.Table(self, f"{resource_prefix}-run-profiles",
+            partition_key=dynamodb.Attribute(name="profile_key", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="finished_at", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=REMOVAL_POLICY,
+        )
+
+        # Output the run profile table name
+        CfnOutput(self, "ProfileTableName",
+            value=profile_table.table_name,
+            description="The name of the run profile table",
+            export_name="ProfileTableName"
+        )
+
         # Creating IAM Role for Batch Instance
         batch_instance_role = iam.Role(
             self,
@@ -131,6 +162,16 @@ class BatchStack(Stack):
 
         # Granting read/write permissions to S3 bucket for the batch instance role
         s3_bucket.grant_read_write(batch_instance_role)
+
+        # Granting write permissions to the run profile table for the batch instance role
+        profile_table.grant_write_data(batch_instance_role)
+
+        # Allow publishing the input cache metrics
+        batch_instance_role.add_to_policy(iam.PolicyStatement(
+            actions=["cloudwatch:PutMetricData"],
+            resources=["*"],
+            conditions={"StringEquals": {"cloudwatch:namespace": INPUT_CACHE_METRICS_NAMESPACE}},
+        ))
     
         # Creating Batch Instance Profile
         batch_instance_profile = iam.CfnInstanceProfile(
@@ -180,34 +221,48 @@ class BatchStack(Stack):
         )
 
 
-        fsx_filesystem = fsx.LustreFileSystem(self, f"{resource_prefix}-fsx",
-            vpc=network_stack.vpc,
-            vpc_subnet=network_stack.vpc.private_subnets[0],
-            storage_capacity_gib=1200,
-            security_group = fsx_security_group,
-            removal_policy=REMOVAL_POLICY,
-            lustre_configuration={
-            "per_unit_storage_throughput":50,
-            "data_compression_type" : fsx.LustreDataCompressionType.LZ4,                
-            "deployment_type": fsx.LustreDeploymentType.PERSISTENT_1,
-            "export_path": f"s3://{AWS_BUCKET}/",
-            "import_path": f"s3://{AWS_BUCKET}/",
-            "auto_import_policy": fsx.LustreAutoImportPolicy.NEW_CHANGED_DELETED
-            }
-        )
+        # In the multi-AZ layout every private subnet gets its own FSx filesystem, launch template,
+        # compute environment and job queue. All filesystems are linked to the same bucket.
+        # The first AZ keeps the single-AZ resource names so switching layouts doesn't replace it.
+        if MULTI_AZ:
+            az_subnets = [[subnet] for subnet in network_stack.vpc.private_subnets]
+        else:
+            az_subnets = [network_stack.vpc.private_subnets]
+
+        self.compute_environments = []
+        self.job_queues = []
+        for i, subnets in enumerate(az_subnets):
+            suffix = "" if i == 0 else f"-az{i}"
+            output_suffix = "" if i == 0 else str(i)
+
+            fsx_filesystem = fsx.LustreFileSystem(self, f"{resource_prefix}-fsx{suffix}",
+                vpc=network_stack.vpc,
+                vpc_subnet=subnets[0],
+                storage_capacity_gib=FSX_STORAGE_CAPACITY,
+                security_group = fsx_security_group,
+                removal_policy=REMOVAL_POLICY,
+                lustre_configuration={
+                "per_unit_storage_throughput":FSX_THROUGHPUT_PER_TIB,
+                "data_compression_type" : fsx.LustreDataCompressionType.LZ4,                
+                "deployment_type": fsx.LustreDeploymentType.PERSISTENT_1,
+                "export_path": f"s3://{AWS_BUCKET}/",
+                "import_path": f"s3://{AWS_BUCKET}/",
+                "auto_import_policy": fsx.LustreAutoImportPolicy.NEW_CHANGED_DELETED
+                }
+            )
 
-        # Output the FSx FileSystem ID
-        CfnOutput(self, "FSxFileSystemID",
-            value=fsx_filesystem.file_system_id,
-            description="The ID of the FSx FileSystem",
-            export_name="FSxFileSystemID"
-        )
+            # Output the FSx FileSystem ID
+            CfnOutput(self, f"FSxFileSystemID{output_suffix}",
+                value=fsx_filesystem.file_system_id,
+                description="The ID of the FSx FileSystem",
+                export_name=f"FSxFileSystemID{output_suffix}"
+            )
 
 
 
-        # Create Launch Template
+            # Create Launch Template
 
-        fsx_user_data = f"""MIME-Version: 1.0
+            fsx_user_data = f"""MIME-Version: 1.0
 Content-Type: multipart/mixed; boundary="==MYBOUNDARY=="
 
 --==MYBOUNDARY==
@@ -218,85 +273,95 @@ runcmd:
 - amazon-linux-extras install -y lustre2.10
 - mkdir -p ${{fsx_directory}}
 - mount -t lustre {fsx_filesystem.file_system_id}.fsx.{AWS_REGION}.amazonaws.com@tcp:/{fsx_filesystem.mount_name} ${{fsx_directory}}
+- cache_directory=/cache
+- mkdir -p ${{cache_directory}}
+- blkid /dev/xvdcz || mkfs -t xfs /dev/xvdcz
+- mount /dev/xvdcz ${{cache_directory}} && touch ${{cache_directory}}/.mounted
  
 --==MYBOUNDARY==--
 """
 
 
-        commands_user_data = ec2.UserData.for_linux()
-        commands_user_data.add_commands(fsx_user_data)
-
-        fsx_lt = ec2.LaunchTemplate(
-            self,
-            f"{resource_prefix}-launch-template-batch",
-            launch_template_name=f"{resource_prefix}-launch-template-batch",
-            user_data = commands_user_data,
-            machine_image=ecs.EcsOptimizedImage.amazon_linux2(),
-            detailed_monitoring = True,
-            require_imdsv2 =True,
-            role = batch_instance_role,
-            block_devices = [ec2.BlockDevice(
-                        device_name="/dev/xvdcz",
-                        volume=ec2.BlockDeviceVolume.ebs(EBS_VOL_SIZE)                                                              
-                    )
-                    ]
+            commands_user_data = ec2.UserData.for_linux()
+            commands_user_data.add_commands(fsx_user_data)
+
+            fsx_lt = ec2.LaunchTemplate(
+                self,
+                f"{resource_prefix}-launch-template-batch{suffix}",
+                launch_template_name=f"{resource_prefix}-launch-template-batch{suffix}",
+                user_data = commands_user_data,
+                machine_image=ecs.EcsOptimizedImage.amazon_linux2(),
+                detailed_monitoring = True,
+                require_imdsv2 =True,
+                role = batch_instance_role,
+                block_devices = [ec2.BlockDevice(
+                            device_name="/dev/xvdcz",
+                            volume=ec2.BlockDeviceVolume.ebs(EBS_VOL_SIZE)                                                              
+                        )
+                        ]
 
-        )
+            )
 
 
-        # Output the EC2 Launch Template ID
-        CfnOutput(self, "EC2LaunchTemplateID",
-            value=fsx_lt.launch_template_id,
-            description="The ID of the EC2 Launch Template",
-            export_name="EC2LaunchTemplateID"
-        )
+            # Output the EC2 Launch Template ID
+            CfnOutput(self, f"EC2LaunchTemplateID{output_suffix}",
+                value=fsx_lt.launch_template_id,
+                description="The ID of the EC2 Launch Template",
+                export_name=f"EC2LaunchTemplateID{output_suffix}"
+            )
 
  
 
 
-        # Create Batch Compute Environment
-        self.compute_environment =  batch.ManagedEc2EcsComputeEnvironment(self, f"{resource_prefix}-batch-compute",
-            vpc=network_stack.vpc,
-            #spot=True,
-            #spot_bid_percentage=COMPUTE_BID_PERCENT,
-            allocation_strategy=batch.AllocationStrategy.BEST_FIT_PROGRESSIVE,
-            minv_cpus= COMPUTE_MIN_CPU,
-            maxv_cpus= COMPUTE_MAX_CPU,
-            instance_classes=[INSTANCE_CLASS],
-            vpc_subnets=ec2.SubnetSelection(subnets=network_stack.vpc.private_subnets),  
-            instance_role=batch_instance_role,
-            security_groups=[network_stack.sg, fsx_security_group],               
-            # desiredv_cpus=COMPUTE_MIN_CPU,            
-            launch_template= fsx_lt,
-            terminate_on_update = False ,
-            update_to_latest_image_version = True,
-            update_timeout = Duration.minutes(30),
-            enabled = True
+            # Create Batch Compute Environment
+            compute_environment =  batch.ManagedEc2EcsComputeEnvironment(self, f"{resource_prefix}-batch-compute{suffix}",
+                vpc=network_stack.vpc,
+                #spot=True,
+                #spot_bid_percentage=COMPUTE_BID_PERCENT,
+                allocation_strategy=batch.AllocationStrategy.BEST_FIT_PROGRESSIVE,
+                minv_cpus= COMPUTE_MIN_CPU,
+                maxv_cpus= COMPUTE_MAX_CPU,
+                instance_classes=[INSTANCE_CLASS],
+                vpc_subnets=ec2.SubnetSelection(subnets=subnets),  
+                instance_role=batch_instance_role,
+                security_groups=[network_stack.sg, fsx_security_group],               
+                # desiredv_cpus=COMPUTE_MIN_CPU,            
+                launch_template= fsx_lt,
+                terminate_on_update = False ,
+                update_to_latest_image_version = True,
+                update_timeout = Duration.minutes(30),
+                enabled = True
 
-        )
-        self.compute_environment.node.add_dependency(fsx_lt)
+            )
+            compute_environment.node.add_dependency(fsx_lt)
 
-           
-        self.job_queue_compute_environment = batch.JobQueue(self, f"{resource_prefix}-batch-compute-queue-1",
-            priority=1
-        )
-        self.job_queue_compute_environment.add_compute_environment(self.compute_environment, 1)
+               
+            job_queue = batch.JobQueue(self, f"{resource_prefix}-batch-compute-queue-{i + 1}",
+                priority=1
+            )
+            job_queue.add_compute_environment(compute_environment, 1)
 
 
 
-        # Output the Batch Compute Environment ARN
-        CfnOutput(self, "BatchComputeEnvironmentARN",
-            value=self.compute_environment.compute_environment_arn,
-            description="The ARN of the Batch Compute Environment",
-            export_name="BatchComputeEnvironmentARN"
-        )
+            # Output the Batch Compute Environment ARN
+            CfnOutput(self, f"BatchComputeEnvironmentARN{output_suffix}",
+                value=compute_environment.compute_environment_arn,
+                description="The ARN of the Batch Compute Environment",
+                export_name=f"BatchComputeEnvironmentARN{output_suffix}"
+            )
 
-        # Output the Batch Job Queue ARN
-        CfnOutput(self, "BatchJobQueueARN",
-            value=self.job_queue_compute_environment.job_queue_arn,
-            description="The ARN of the Batch Job Queue",
-            export_name="BatchJobQueueARN"
-        )
+            # Output the Batch Job Queue ARN
+            CfnOutput(self, f"BatchJobQueueARN{output_suffix}",
+                value=job_queue.job_queue_arn,
+                description="The ARN of the Batch Job Queue",
+                export_name=f"BatchJobQueueARN{output_suffix}"
+            )
+
+            self.compute_environments.append(compute_environment)
+            self.job_queues.append(job_queue)
+
+        self.compute_environment = self.compute_environments[0]
+        self.job_queue_compute_environment = self.job_queues[0]
 
 
 
@@ -322,6 +387,14 @@ runcmd:
             readonly=False
         )        
 
+        # Host volume for the input cache on the instance's EBS volume, shared by the containers on a host
+        cache_volume = batch.HostVolume(
+            container_path="/cache",
+            name="cache",
+            host_path="/cache",
+            readonly=False
+        )
+
 
 
        # Job definition 1
@@ -335,7 +408,7 @@ runcmd:
                 privileged= True,   
                 execution_role=batch_instance_role,
                 job_role = batch_instance_role,
-                volumes=[host_volume],
+                volumes=[host_volume, cache_volume],
                 logging=ecs.LogDrivers.aws_logs(
                     stream_prefix=f"{LOG_GROUP_NAME}",
                 ),                
@@ -349,7 +422,14 @@ runcmd:
                                                     "REQUIREMENTS_FILE" : str(REQUIREMENTS_FILE), 
                                                     "INPUT" : "input", 
                                                     "OUTPUT" : "output",                                                     
-                                                    "PIPELINE" : "pipeline.cppipe"                                              
+                                                    "PIPELINE" : "pipeline.cppipe",
+                                                    "OUTPUT_MODE" : str(OUTPUT_MODE),
+                                                    "OUTPUT_SHARD_SIZE_MB" : str(OUTPUT_SHARD_SIZE_MB),
+                                                    "OUTPUT_SMALL_FILE_MB" : str(OUTPUT_SMALL_FILE_MB),
+                                                    "PROFILE_TABLE" : profile_table.table_name,
+                                                    "INPUT_CACHE_PATH" : "/cache",
+                                                    "INPUT_CACHE_SIZE_GB" : str(INPUT_CACHE_SIZE),
+                                                    "INPUT_CACHE_METRICS_NAMESPACE" : str(INPUT_CACHE_METRICS_NAMESPACE),
                                                     
                 },                           
             
@@ -394,7 +474,11 @@ runcmd:
                                                     "REQUIREMENTS_FILE" : str(REQUIREMENTS_FILE), 
                                                     "INPUT" : "input", 
                                                     "OUTPUT" : "output",                                                     
-                                                    "PIPELINE" : "pipeline.cppipe"                                              
+                                                    "PIPELINE" : "pipeline.cppipe",
+                                                    "OUTPUT_MODE" : str(OUTPUT_MODE),
+                                                    "OUTPUT_SHARD_SIZE_MB" : str(OUTPUT_SHARD_SIZE_MB),
+                                                    "OUTPUT_SMALL_FILE_MB" : str(OUTPUT_SMALL_FILE_MB),
+                                                    "PROFILE_TABLE" : profile_table.table_name,
                                                     
                 },                           
             
@@ -424,8 +508,8 @@ runcmd:
                     ],
                     resources=[
                         
-                               self.compute_environment.compute_environment_arn, 
-                               self.job_queue_compute_environment.job_queue_arn,
+                               *[ce.compute_environment_arn for ce in self.compute_environments], 
+                               *[queue.job_queue_arn for queue in self.job_queues],
                                job_definition_compute.job_definition_arn,
                                self.fargate_environment.compute_environment_arn, 
                                self.job_queue_fargate_environment.job_queue_arn,
@@ -433,11 +517,25 @@ runcmd:
 
                                ],
                 ),
+                # ListJobs and DescribeJobs don't support resource-level permissions, used to spread jobs
+                # across AZ queues and to check the status of claimed illumination jobs
+                iam.PolicyStatement(
+                    actions=[
+                        'batch:ListJobs',
+                        'batch:DescribeJobs',
+                    ],
+                    resources=["*"],
+                ),
                 
             ]
         )
         lambda_policy.attach_to_role(lambda_role)
 
+        # Lambda reads the pipeline and input listing to build profile keys, queries the run profiles
+        # and records its claims on illumination caches in the profile table
+        s3_bucket.grant_read(lambda_role)
+        profile_table.grant_read_write_data(lambda_role)
+
 
         # # cdk nag to suppress wildcard permissions
         # lambda_policy.node.add_metadata('cdk_nag', {
@@ -454,10 +552,11 @@ runcmd:
 
         # Create a Lambda function to process messages from the SQS queue
         function = lambda_.Function(self, f"{resource_prefix}-process-sqs",
-            runtime=lambda_.Runtime.PYTHON_3_8,
+            runtime=lambda_.Runtime.PYTHON_3_11,
             handler="lambda-handler.handler",
             code=lambda_.Code.from_asset("lambda"),
             role=lambda_role,
+            timeout=Duration.seconds(LAMBDA_TIMEOUT),
             environment={
                 "BATCH_JOB_QUEUE": self.job_queue_compute_environment.job_queue_arn
             }
@@ -468,7 +567,8 @@ runcmd:
         self.queue.grant_consume_messages(function)        
         
         #Create an SQS event source for Lambda
-        sqs_event_source = lambda_event_source.SqsEventSource(self.queue)
+        # Messages the Lambda reports as failed stay in the queue and are delivered again
+        sqs_event_source = lambda_event_source.SqsEventSource(self.queue, report_batch_item_failures=True)
 
         #Add SQS event source to the Lambda function
         function.add_event_source(sqs_event_source)
@@ -481,6 +581,20 @@ runcmd:
         function.add_environment("BATCH_JOB_VCPUS", str(JOB_CPU))        
         function.add_environment("AWS_BUCKET", str(AWS_BUCKET))      
         function.add_environment("QUEUE_URL", self.queue.queue_url) 
+        if MULTI_AZ:
+            function.add_environment("BATCH_JOB_QUEUES", ",".join(queue.job_queue_arn for queue in self.job_queues))
+        function.add_environment("PROFILE_TABLE", profile_table.table_name)
+        function.add_environment("PROFILE_SAFETY_MARGIN", str(PROFILE_SAFETY_MARGIN))
+        function.add_environment("PROFILE_HISTORY", str(PROFILE_HISTORY))
+        # Predicted resources are capped at the largest instance of the class, as Batch leaves jobs
+        # that fit no instance RUNNABLE forever. Classes without known sizes aren't capped.
+        instance_sizes = INSTANCE_TYPES.get(instance_class_name(INSTANCE_CLASS))
+        if instance_sizes:
+            _, max_vcpus, max_memory_gib, _ = max(instance_sizes, key=lambda size: size[2])
+            max_memory = int(max_memory_gib * 1024 * SIMULATOR_CONFIG["SIM_INSTANCE_MEMORY_AVAILABLE"]) // 256 * 256
+            function.add_environment("MAX_JOB_MEMORY", str(max_memory))
+            function.add_environment("MAX_JOB_VCPUS", str(max_vcpus))
+        function.add_environment("ILLUM_CACHE_PREFIX", str(ILLUM_CACHE_PREFIX))
 
 
         # Output the Lambda Function ARN
@@ -39,10 +39,10 @@ class NetworkStack(Stack):
                 )
             print("log  created")
 
-        # Create a Virtual Private Cloud (VPC) with maximum availability zones set to 1
+        # Create a Virtual Private Cloud (VPC), spanning MAX_AZS availability zones in the multi-AZ layout
         self.vpc = ec2.Vpc(
             self, f"{resource_prefix}-vpc",
-            max_azs=1
+            max_azs=config["MAX_AZS"] if config["MULTI_AZ"] else 1
         )
 
         # Setup IAM user for logs
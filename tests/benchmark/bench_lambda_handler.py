@@ -0,0 +1,103 @@
+"""
+Benchmark of the Lambda handler's cold start and per-message overhead, with fake AWS clients.
+
+    python -m tests.benchmark.bench_lambda_handler
+
+Cold start is measured in fresh interpreters: the module import (including boto3) and the
+first invocation, which parses the config and creates the clients. Per-message overhead is
+the warm handler time divided by the number of jobs submitted, for single-AZ submissions,
+right-sized submissions reading the profile store and multi-AZ submissions.
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from tests.fake_aws import (LAMBDA_ENV, FakeBatch, FakeDynamoDB, FakeS3, FakeSQS,
+                            load_lambda_handler, sqs_event)
+
+REPO_ROOT = os.path.join(os.path.dirname(__file__), "..", "..")
+
+# Run in a fresh interpreter to time the import and the first invocation
+COLD_START = """
+import json, time
+start = time.perf_counter()
+from tests.fake_aws import FakeBatch, FakeS3, FakeSQS, load_lambda_handler, sqs_event
+module = load_lambda_handler()
+imported = time.perf_counter()
+module._clients.update(batch=FakeBatch(), sqs=FakeSQS(), s3=FakeS3())
+module.handler(sqs_event([json.dumps({"pipeline": "p.cppipe", "input": "i/", "output": "o/"})]), None)
+invoked = time.perf_counter()
+print(json.dumps({"import": imported - start, "first_invocation": invoked - imported}))
+"""
+
+MESSAGE = {
+    "pipeline": "examples/ExampleVitraImages/ExampleVitra.cppipe",
+    "input": "examples/ExampleVitraImages/images/",
+    "output": "examples/ExampleVitraImages/output/",
+}
+
+SCENARIOS = {
+    "single-az": {},
+    "right-sized": {"PROFILE_TABLE": "profiles"},
+    "multi-az": {"BATCH_JOB_QUEUES": ",".join(f"{LAMBDA_ENV['BATCH_JOB_QUEUE']}-az{i}" for i in range(3))},
+}
+
+
+def cold_start(runs):
+    env = dict(os.environ, **LAMBDA_ENV)
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", COLD_START], cwd=REPO_ROOT, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(output.splitlines()[-1]))
+    return {key: statistics.median(sample[key] for sample in samples) for key in samples[0]}
+
+
+def per_message(scenario, records, jobs_per_record, iterations):
+    # The config is parsed on the first invocation, from the scenario's environment
+    os.environ.update(LAMBDA_ENV, **SCENARIOS[scenario])
+    module = load_lambda_handler(f"lambda_handler_{scenario.replace('-', '_')}")
+    module.load_config()
+    for key in SCENARIOS[scenario]:
+        del os.environ[key]
+
+    images = {f"{MESSAGE['input']}{i}.tif": 8 * 1024 * 1024 for i in range(100)}
+    event = sqs_event([json.dumps([MESSAGE] * jobs_per_record)] * records)
+    samples = []
+    for _ in range(iterations):
+        batch = FakeBatch(backlog=10)
+        module._clients.update(batch=batch, sqs=FakeSQS(), s3=FakeS3(images),
+                               dynamodb=FakeDynamoDB([(3000, 1.2)] * 20))
+        start = time.perf_counter()
+        module.handler(event, None)
+        samples.append((time.perf_counter() - start) / len(batch.submitted))
+    return statistics.median(samples)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Lambda handler with fake AWS clients.")
+    parser.add_argument("--cold-runs", type=int, default=5, help="Fresh interpreters used for the cold start")
+    parser.add_argument("--records", type=int, default=10, help="SQS records per event, the Lambda batch size")
+    parser.add_argument("--jobs-per-record", type=int, default=10, help="Jobs in each SQS message")
+    parser.add_argument("--iterations", type=int, default=50, help="Warm invocations per scenario")
+    args = parser.parse_args(argv)
+
+    # Keep log formatting out of the measurement
+    logging.disable(logging.CRITICAL)
+
+    cold = cold_start(args.cold_runs)
+    print(f"cold start: import {cold['import'] * 1000:.1f} ms, "
+          f"first invocation {cold['first_invocation'] * 1000:.1f} ms")
+    for scenario in SCENARIOS:
+        overhead = per_message(scenario, args.records, args.jobs_per_record, args.iterations)
+        print(f"{scenario}: {overhead * 1e6:.1f} us per job")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""
+In-memory stand-ins for the AWS clients used by the Lambda handler.
+"""
+import importlib.util
+import itertools
+import os
+
+from botocore.exceptions import ClientError
+
+LAMBDA_HANDLER_PATH = os.path.join(os.path.dirname(__file__), "..", "lambda", "lambda-handler.py")
+
+LAMBDA_ENV = {
+    "BATCH_JOB_NAME": "cpb-ba-job-default",
+    "BATCH_JOB_DEFINITION": "arn:aws:batch:us-east-1:123456789012:job-definition/cpb:1",
+    "BATCH_JOB_QUEUE": "arn:aws:batch:us-east-1:123456789012:job-queue/cpb-1",
+    "BATCH_JOB_ATTEMPTS": "3",
+    "BATCH_JOB_MEMORY": "4096",
+    "BATCH_JOB_VCPUS": "4",
+    "AWS_BUCKET": "cpb-ba-data-cp-123456789012-us-east-1",
+    "QUEUE_URL": "https://sqs.us-east-1.amazonaws.com/123456789012/cpb-ba-queue",
+}
+
+
+def load_lambda_handler(name="lambda_handler"):
+    """
+    Import lambda/lambda-handler.py, whose file name isn't a valid module name.
+    """
+    spec = importlib.util.spec_from_file_location(name, LAMBDA_HANDLER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeBatch:
+    def __init__(self, backlog=0):
+        # Waiting jobs per job status, for every queue or by queue
+        self.backlog = backlog
+        self.submitted = []
+        self.listed = []
+        # Job ID -> status, submitted jobs are RUNNABLE
+        self.statuses = {}
+        self._ids = itertools.count()
+
+    def submit_job(self, **kwargs):
+        self.submitted.append(kwargs)
+        job_id = f"job-{next(self._ids)}"
+        self.statuses[job_id] = "RUNNABLE"
+        return {"jobId": job_id, "jobName": kwargs["jobName"]}
+
+    def describe_jobs(self, jobs):
+        return {"jobs": [{"jobId": job_id, "status": self.statuses[job_id]} for job_id in jobs
+                         if job_id in self.statuses]}
+
+    def list_jobs(self, jobQueue, jobStatus, maxResults=100):
+        self.listed.append((jobQueue, jobStatus))
+        backlog = self.backlog.get(jobQueue, 0) if isinstance(self.backlog, dict) else self.backlog
+        return {"jobSummaryList": [{}] * min(backlog, maxResults)}
+
+
+class FakeSQS:
+    def __init__(self):
+        self.deleted = []
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.deleted.append(ReceiptHandle)
+
+
+class FakeS3:
+    def __init__(self, objects=None):
+        # Key -> size
+        self.objects = objects or {}
+        self.requests = []
+
+    def head_object(self, Bucket, Key):
+        self.requests.append(("head_object", Key))
+        return {"ETag": f'"{abs(hash(Key)):x}"'}
+
+    def list_objects_v2(self, Bucket, Prefix, MaxKeys=1000):
+        self.requests.append(("list_objects_v2", Prefix))
+        contents = [{"Key": key, "Size": size} for key, size in self.objects.items() if key.startswith(Prefix)]
+        return {"Contents": contents[:MaxKeys]}
+
+
+class FakeDynamoDB:
+    def __init__(self, runs=None):
+        # (peak_rss_mb, cpu_used) or (peak_rss_mb, cpu_used, requested_memory, exit_status)
+        self.runs = runs or []
+        self.queries = []
+        # (profile_key, finished_at) -> item, for the items written by the Lambda
+        self.items = {}
+
+    def query(self, **kwargs):
+        self.queries.append(kwargs)
+        fields = ("peak_rss_mb", "cpu_used", "requested_memory", "exit_status")
+        return {"Items": [{name: {"N": str(value)} for name, value in zip(fields, run)} for run in self.runs]}
+
+    def _check(self, item, condition, values):
+        # Supports the 'attribute_not_exists(name)' and 'name = :value' conditions used by the Lambda
+        if condition.startswith("attribute_not_exists("):
+            met = item is None
+        else:
+            name, value = (part.strip() for part in condition.split("="))
+            met = item is not None and item.get(name) == values[value]
+        if not met:
+            raise ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "PutItem")
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeValues=None):
+        key = (Item["profile_key"]["S"], Item["finished_at"]["S"])
+        if ConditionExpression:
+            self._check(self.items.get(key), ConditionExpression, ExpressionAttributeValues)
+        self.items[key] = dict(Item)
+
+    def get_item(self, TableName, Key, ConsistentRead=False):
+        item = self.items.get((Key["profile_key"]["S"], Key["finished_at"]["S"]))
+        return {"Item": dict(item)} if item else {}
+
+    def delete_item(self, TableName, Key, ConditionExpression, ExpressionAttributeValues):
+        key = (Key["profile_key"]["S"], Key["finished_at"]["S"])
+        self._check(self.items.get(key), ConditionExpression, ExpressionAttributeValues)
+        del self.items[key]
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression, ExpressionAttributeValues):
+        item = self.items.get((Key["profile_key"]["S"], Key["finished_at"]["S"]))
+        self._check(item, ConditionExpression, ExpressionAttributeValues)
+        # Supports 'SET name = :value'
+        name, value = (part.strip() for part in UpdateExpression[len("SET "):].split("="))
+        item[name] = ExpressionAttributeValues[value]
+
+
+def sqs_event(bodies):
+    """
+    Build an SQS event with one record per message body.
+    """
+    return {"Records": [
+        {"messageId": f"m{i}", "receiptHandle": f"r{i}", "body": body} for i, body in enumerate(bodies)
+    ]}
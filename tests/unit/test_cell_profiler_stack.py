@@ -1,15 +1,115 @@
+import os
+
 import aws_cdk as core
 import aws_cdk.assertions as assertions
+import pytest
 
-from cell_profiler.cell_profiler_stack import CellProfilerStack
+# constants.py reads the deployment account and region from the CDK environment
+os.environ.setdefault("CDK_DEFAULT_ACCOUNT", "123456789012")
+os.environ.setdefault("CDK_DEFAULT_REGION", "us-east-1")
 
-# example tests. To run these tests, uncomment this file along with the example
-# resource in cell_profiler/cell_profiler_stack.py
-def test_sqs_queue_created():
+import constants
+from stack.network import NetworkStack
+from stack.batch import BatchStack
+
+
+@pytest.fixture(autouse=True)
+def offline_log_groups(monkeypatch):
+    # NetworkStack looks up existing log groups with boto3, keep synthesis offline
+    monkeypatch.setattr(NetworkStack, "log_group_exists", staticmethod(lambda log_group_name: False))
+
+
+def synth(**overrides):
+    config = dict(constants.DEV_CONFIG, **overrides)
     app = core.App()
-    stack = CellProfilerStack(app, "cell-profiler")
-    template = assertions.Template.from_stack(stack)
+    network_stack = NetworkStack(app, "network-cpb", env=constants.DEV_ENV, config=config)
+    batch_stack = BatchStack(app, "batch-cpb", env=constants.DEV_ENV, config=config, network_stack=network_stack)
+    return assertions.Template.from_stack(network_stack), assertions.Template.from_stack(batch_stack)
+
+
+def test_sqs_queue_created():
+    _, template = synth()
+
+    template.has_resource_properties("AWS::SQS::Queue", {
+        "VisibilityTimeout": constants.DEV_CONFIG["SQS_MESSAGE_VISIBILITY"]
+    })
+
+
+def test_single_az_topology():
+    network, template = synth(MULTI_AZ=False)
+
+    network.resource_count_is("AWS::EC2::Subnet", 2)
+    template.resource_count_is("AWS::FSx::FileSystem", 1)
+    template.resource_count_is("AWS::EC2::LaunchTemplate", 1)
+    # One EC2 compute environment and queue plus the Fargate ones
+    template.resource_count_is("AWS::Batch::ComputeEnvironment", 2)
+    template.resource_count_is("AWS::Batch::JobQueue", 2)
+
+    functions = template.find_resources("AWS::Lambda::Function")
+    for function in functions.values():
+        variables = function["Properties"].get("Environment", {}).get("Variables", {})
+        assert "BATCH_JOB_QUEUES" not in variables
+
+
+def test_multi_az_topology():
+    network, template = synth(MULTI_AZ=True, MAX_AZS=2)
+
+    # A public and a private subnet per AZ
+    network.resource_count_is("AWS::EC2::Subnet", 4)
+    template.resource_count_is("AWS::FSx::FileSystem", 2)
+    template.resource_count_is("AWS::EC2::LaunchTemplate", 2)
+    template.resource_count_is("AWS::Batch::ComputeEnvironment", 3)
+    template.resource_count_is("AWS::Batch::JobQueue", 3)
+
+    # Every filesystem is linked to the same bucket and lives in its own subnet
+    filesystems = template.find_resources("AWS::FSx::FileSystem").values()
+    assert len({str(fs["Properties"]["SubnetIds"]) for fs in filesystems}) == 2
+    assert len({str(fs["Properties"]["LustreConfiguration"]["ImportPath"]) for fs in filesystems}) == 1
+
+    # Every EC2 compute environment is pinned to a single subnet
+    environments = template.find_resources("AWS::Batch::ComputeEnvironment", {
+        "Properties": {"Type": "managed", "ComputeResources": {"Type": "EC2"}}
+    }).values()
+    assert len(environments) == 2
+    for environment in environments:
+        assert len(environment["Properties"]["ComputeResources"]["Subnets"]) == 1
+
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Environment": {"Variables": {"BATCH_JOB_QUEUES": assertions.Match.any_value()}}
+    })
+
+
+def test_input_cache_volume_mounted():
+    _, template = synth()
+
+    template.has_resource_properties("AWS::Batch::JobDefinition", {
+        "ContainerProperties": {
+            "Volumes": assertions.Match.array_with([{"Name": "cache", "Host": {"SourcePath": "/cache"}}]),
+            "MountPoints": assertions.Match.array_with([
+                {"SourceVolume": "cache", "ContainerPath": "/cache", "ReadOnly": False}
+            ]),
+        }
+    })
+
+
+def test_lambda_runtime():
+    _, template = synth()
+
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "lambda-handler.handler",
+        "Runtime": "python3.11",
+        "Timeout": 120,
+        # Largest c4 instance: 36 vCPUs, 60 GiB of which 94% is available to containers
+        "Environment": {"Variables": assertions.Match.object_like({
+            "MAX_JOB_MEMORY": "57600",
+            "MAX_JOB_VCPUS": "36",
+        })},
+    })
+
+
+def test_lambda_reports_batch_item_failures():
+    _, template = synth()
 
-#     template.has_resource_properties("AWS::SQS::Queue", {
-#         "VisibilityTimeout": 300
-#     })
+    template.has_resource_properties("AWS::Lambda::EventSourceMapping", {
+        "FunctionResponseTypes": ["ReportBatchItemFailures"],
+    })
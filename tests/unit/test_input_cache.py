@@ -0,0 +1,92 @@
+import hashlib
+import importlib.util
+import os
+
+import pytest
+
+pytest.importorskip("boto3")
+
+INPUT_CACHE_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "docker", "input-cache.py")
+
+
+@pytest.fixture
+def input_cache(tmp_path, monkeypatch):
+    spec = importlib.util.spec_from_file_location("input_cache", INPUT_CACHE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    # List the FSx input folder in place of the bucket, with the MD5 as ETag like S3
+    def list_inputs(bucket, prefix):
+        source = tmp_path / "fsx" / prefix
+        for path in sorted(source.rglob("*")):
+            if path.is_file():
+                data = path.read_bytes()
+                yield str(path.relative_to(source)), hashlib.md5(data).hexdigest(), len(data)
+
+    monkeypatch.setattr(module, "list_inputs", list_inputs)
+    return module
+
+
+def write_inputs(tmp_path, prefix, files):
+    for relpath, data in files.items():
+        path = tmp_path / "fsx" / prefix / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+
+def stage(input_cache, tmp_path, prefix, job):
+    return input_cache.stage("bucket", prefix, str(tmp_path / "fsx" / prefix), str(tmp_path / "cache"),
+                             str(tmp_path / "cache" / "jobs" / job))
+
+
+def blobs(tmp_path):
+    return sorted(path for path in (tmp_path / "cache" / "objects").rglob("*") if path.is_file())
+
+
+def test_stage_counts_hits_and_misses(input_cache, tmp_path):
+    files = {"A01_s1_DNA.tif": b"dna" * 100, "A01_s1_RNA.tif": b"rna" * 200}
+    write_inputs(tmp_path, "plate1/", files)
+    # Another plate with one image identical to plate1
+    write_inputs(tmp_path, "plate2/", {"A01_s1_DNA.tif": b"dna" * 100, "A01_s1_ER.tif": b"er" * 50})
+
+    first = stage(input_cache, tmp_path, "plate1/", "job1")
+    second = stage(input_cache, tmp_path, "plate1/", "job2")
+    third = stage(input_cache, tmp_path, "plate2/", "job3")
+
+    assert first == {"hits": 0, "misses": 2, "hit_bytes": 0, "miss_bytes": 900}
+    assert second == {"hits": 2, "misses": 0, "hit_bytes": 900, "miss_bytes": 0}
+    assert third == {"hits": 1, "misses": 1, "hit_bytes": 300, "miss_bytes": 100}
+    for job in ("job1", "job2"):
+        for relpath, data in files.items():
+            assert (tmp_path / "cache" / "jobs" / job / relpath).read_bytes() == data
+    assert len(blobs(tmp_path)) == 3
+    assert os.listdir(tmp_path / "cache" / "tmp") == []
+
+
+def test_evict_removes_least_recently_used(input_cache, tmp_path):
+    write_inputs(tmp_path, "plate1/", {f"image{i}.tif": bytes([i]) * 1000 for i in range(3)})
+    stage(input_cache, tmp_path, "plate1/", "job1")
+    # Least recently used first: image1, image2, image0
+    for path in blobs(tmp_path):
+        last_used = {0: 300, 1: 100, 2: 200}[path.read_bytes()[0]]
+        os.utime(path, (last_used, last_used))
+
+    evicted = input_cache.evict(str(tmp_path / "cache"), max_size=1000)
+
+    assert evicted == 2
+    assert [path.read_bytes()[0] for path in blobs(tmp_path)] == [0]
+    # The job folder was made by a running job, its links still work after eviction
+    for i in range(3):
+        assert (tmp_path / "cache" / "jobs" / "job1" / f"image{i}.tif").read_bytes() == bytes([i]) * 1000
+
+
+def test_evict_removes_stale_job_folders(input_cache, tmp_path):
+    write_inputs(tmp_path, "plate1/", {"image.tif": b"x" * 10})
+    stage(input_cache, tmp_path, "plate1/", "job1")
+    stage(input_cache, tmp_path, "plate1/", "job2")
+    stale = tmp_path / "cache" / "jobs" / "job1"
+    os.utime(stale, (0, 0))
+
+    input_cache.evict(str(tmp_path / "cache"), max_size=1000)
+
+    assert os.listdir(tmp_path / "cache" / "jobs") == ["job2"]
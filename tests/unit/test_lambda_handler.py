@@ -0,0 +1,261 @@
+import json
+
+import pytest
+
+pytest.importorskip("boto3")
+
+from tests.fake_aws import (LAMBDA_ENV, FakeBatch, FakeDynamoDB, FakeS3, FakeSQS,
+                            load_lambda_handler, sqs_event)
+
+MESSAGE = {
+    "pipeline": "examples/ExampleVitraImages/ExampleVitra.cppipe",
+    "input": "examples/ExampleVitraImages/images/",
+    "output": "examples/ExampleVitraImages/output0/",
+}
+
+ILLUM_MESSAGE = dict(
+    MESSAGE,
+    illum_pipeline="examples/ExampleVitraImages/Illum.cppipe",
+    plate="vitra",
+    plate_input="examples/ExampleVitraImages/images/",
+)
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    for key, value in LAMBDA_ENV.items():
+        monkeypatch.setenv(key, value)
+    module = load_lambda_handler()
+    module._clients.update(batch=FakeBatch(), sqs=FakeSQS(), s3=FakeS3(), dynamodb=FakeDynamoDB())
+    return module
+
+
+def test_config_parsed_once(handler, monkeypatch):
+    config = handler.load_config()
+    monkeypatch.setenv("BATCH_JOB_MEMORY", "8192")
+
+    assert handler.load_config() is config
+    assert config.job_memory == "4096"
+    assert config.retry_strategy == {"attempts": 3}
+    assert config.job_queues == ()
+
+
+def test_missing_env_vars_reported_together(monkeypatch, caplog):
+    for key in ("AWS_BUCKET", "QUEUE_URL"):
+        monkeypatch.delenv(key, raising=False)
+    module = load_lambda_handler()
+
+    assert module.load_config() is None
+    assert "AWS_BUCKET, QUEUE_URL" in caplog.text
+
+
+@pytest.mark.parametrize("message, error", [
+    (MESSAGE, None),
+    (dict(MESSAGE, job_memory=8192, job_vcpu="8"), None),
+    ({"input": "a/"}, "missing pipeline; missing output"),
+    (dict(MESSAGE, job_memory="8GB"), "job_memory must be a whole number"),
+    (dict(MESSAGE, output=["a"], output_mode="zip"),
+     "output must be a string; output_mode must be one of files, sharded"),
+    ("examples/", "expected an object, got str"),
+    (ILLUM_MESSAGE, None),
+    (dict(ILLUM_MESSAGE, plate_input=None), "plate requires plate_input"),
+])
+def test_validate_message(handler, message, error):
+    assert handler.validate_message(message) == error
+
+
+def job_environment(job):
+    return {variable["name"]: variable["value"] for variable in job["containerOverrides"]["environment"]}
+
+
+def illum_cache(handler):
+    config = handler.load_config()
+    return f"illum-cache/vitra/{handler.pipeline_hash(config, ILLUM_MESSAGE['illum_pipeline'])}/"
+
+
+def test_handler_submits_valid_messages(handler):
+    body = json.dumps([MESSAGE, {"input": "a/"}, dict(MESSAGE, job_memory="8192", job_vcpu="8")])
+
+    handler.handler(sqs_event([body, "not json"]), None)
+
+    submitted = handler._clients["batch"].submitted
+    assert len(submitted) == 2
+    assert submitted[0]["jobQueue"] == LAMBDA_ENV["BATCH_JOB_QUEUE"]
+    assert submitted[1]["containerOverrides"]["resourceRequirements"] == [
+        {"type": "MEMORY", "value": "8192"}, {"type": "VCPU", "value": "8"}
+    ]
+    assert handler._clients["sqs"].deleted == ["r0"]
+
+
+def test_handler_predicts_resources_from_profiles(handler, monkeypatch):
+    monkeypatch.setenv("PROFILE_TABLE", "profiles")
+    handler._clients["dynamodb"].runs = [(3000, 1.2), (2000, 0.9)]
+
+    handler.handler(sqs_event([json.dumps(MESSAGE)]), None)
+
+    overrides = handler._clients["batch"].submitted[0]["containerOverrides"]
+    assert overrides["resourceRequirements"] == [
+        {"type": "MEMORY", "value": "3840"}, {"type": "VCPU", "value": "2"}
+    ]
+
+
+def test_handler_sends_jobs_to_least_loaded_queue(handler, monkeypatch):
+    queues = ["queue-az0", "queue-az1"]
+    monkeypatch.setenv("BATCH_JOB_QUEUES", ",".join(queues))
+    handler._clients["batch"].backlog = {"queue-az0": 1, "queue-az1": 0}
+
+    handler.handler(sqs_event([json.dumps([MESSAGE] * 6)]), None)
+
+    # queue-az0 starts with one waiting job per status, each submission adds one to its queue
+    assert [job["jobQueue"] for job in handler._clients["batch"].submitted] == [
+        "queue-az1", "queue-az1", "queue-az1", "queue-az0", "queue-az1", "queue-az0"
+    ]
+
+
+def test_queue_backlogs_stop_at_sample_size(handler, monkeypatch):
+    monkeypatch.setenv("BATCH_JOB_QUEUES", "queue-az0,queue-az1")
+    handler._clients["batch"].backlog = {"queue-az0": 500, "queue-az1": 40}
+
+    backlogs = handler.queue_backlogs(handler.load_config())
+
+    assert backlogs == {"queue-az0": handler.BACKLOG_SAMPLE_SIZE, "queue-az1": handler.BACKLOG_SAMPLE_SIZE}
+    assert handler._clients["batch"].listed == [
+        ("queue-az0", "SUBMITTED"), ("queue-az1", "SUBMITTED"), ("queue-az1", "PENDING"), ("queue-az1", "RUNNABLE")
+    ]
+
+
+def test_handler_looks_up_profiles_once_per_pipeline_and_input(handler, monkeypatch):
+    monkeypatch.setenv("PROFILE_TABLE", "profiles")
+    body = json.dumps([MESSAGE, dict(MESSAGE, output="examples/ExampleVitraImages/output1/")])
+
+    handler.handler(sqs_event([body, json.dumps(MESSAGE)]), None)
+
+    assert len(handler._clients["batch"].submitted) == 3
+    assert len(handler._clients["dynamodb"].queries) == 1
+    assert handler._clients["s3"].requests == [
+        ("head_object", MESSAGE["pipeline"]), ("list_objects_v2", MESSAGE["input"])
+    ]
+
+
+@pytest.mark.parametrize("runs, memory", [
+    # OOM-killed at its requested memory: double it
+    ([(3000, 1.2), (4000, 1.0, 4096, 137)], "8192"),
+    # Failed far below its requested memory, not a memory problem
+    ([(3000, 1.2), (1000, 1.0, 4096, 1)], "3840"),
+])
+def test_predict_resources_raises_memory_after_oom(handler, monkeypatch, runs, memory):
+    monkeypatch.setenv("PROFILE_TABLE", "profiles")
+    handler._clients["dynamodb"].runs = runs
+
+    assert handler.predict_resources(handler.load_config(), "key") == (memory, "2")
+
+
+@pytest.mark.parametrize("runs, resources", [
+    # OOM-killed at 32 GB, twice that doesn't fit on a c4.8xlarge
+    ([(32000, 1.0, 32768, 137)], ("57600", "2")),
+    # The margin alone takes a large peak over the largest instance
+    ([(52000, 1.0)], ("57600", "2")),
+    ([(3000, 40.0)], ("3840", "36")),
+])
+def test_predict_resources_capped_at_largest_instance(handler, monkeypatch, caplog, runs, resources):
+    monkeypatch.setenv("PROFILE_TABLE", "profiles")
+    monkeypatch.setenv("MAX_JOB_MEMORY", "57600")
+    monkeypatch.setenv("MAX_JOB_VCPUS", "36")
+    handler._clients["dynamodb"].runs = runs
+
+    assert handler.predict_resources(handler.load_config(), "key") == resources
+    assert "capped at" in caplog.text
+
+
+def test_illumination_computed_once_per_plate(handler, monkeypatch):
+    monkeypatch.setenv("PROFILE_TABLE", "profiles")
+    sites = [dict(ILLUM_MESSAGE, input=f"examples/ExampleVitraImages/images/site{i}/") for i in range(3)]
+
+    handler.handler(sqs_event([json.dumps(sites[:2]), json.dumps(sites[2])]), None)
+    # A later invocation finds the claim of the running job
+    handler.handler(sqs_event([json.dumps(sites[0])]), None)
+
+    cache = illum_cache(handler)
+    illum_job, *analysis_jobs = handler._clients["batch"].submitted
+    assert job_environment(illum_job) == dict(
+        job_environment(illum_job),
+        PIPELINE=ILLUM_MESSAGE["illum_pipeline"],
+        INPUT=ILLUM_MESSAGE["plate_input"],
+        OUTPUT=cache,
+        OUTPUT_MODE="files",
+        OUTPUT_MARKER="_COMPLETE",
+    )
+    assert len(analysis_jobs) == 4
+    for job in analysis_jobs:
+        assert job["dependsOn"] == [{"jobId": "job-0"}]
+        assert job_environment(job)["ILLUM_INPUT"] == cache
+
+
+def test_illumination_cache_hit(handler, monkeypatch):
+    monkeypatch.setenv("PROFILE_TABLE", "profiles")
+    handler._clients["s3"].objects.update({
+        f"{illum_cache(handler)}illum_DNA.npy": 1024,
+        f"{illum_cache(handler)}_COMPLETE": 10,
+    })
+
+    handler.handler(sqs_event([json.dumps(ILLUM_MESSAGE)]), None)
+
+    [job] = handler._clients["batch"].submitted
+    assert job["dependsOn"] == []
+    assert job_environment(job)["ILLUM_INPUT"] == illum_cache(handler)
+    assert handler._clients["dynamodb"].items == {}
+
+
+def test_partial_illumination_cache_is_not_a_hit(handler, monkeypatch):
+    monkeypatch.setenv("PROFILE_TABLE", "profiles")
+    # The illumination job is still uploading its functions
+    handler._clients["s3"].objects[f"{illum_cache(handler)}illum_DNA.npy"] = 1024
+
+    handler.handler(sqs_event([json.dumps(ILLUM_MESSAGE)]), None)
+
+    illum_job, job = handler._clients["batch"].submitted
+    assert job_environment(illum_job)["PIPELINE"] == ILLUM_MESSAGE["illum_pipeline"]
+    assert job["dependsOn"] == [{"jobId": "job-0"}]
+
+
+@pytest.mark.parametrize("status", ["FAILED", "SUCCEEDED"])
+def test_stale_illumination_job_claim_taken_over(handler, monkeypatch, status):
+    monkeypatch.setenv("PROFILE_TABLE", "profiles")
+    batch = handler._clients["batch"]
+
+    handler.handler(sqs_event([json.dumps(ILLUM_MESSAGE)]), None)
+    # The job failed, or succeeded without writing the completion marker
+    batch.statuses["job-0"] = status
+    handler.handler(sqs_event([json.dumps(ILLUM_MESSAGE)]), None)
+
+    assert len(batch.submitted) == 4
+    assert job_environment(batch.submitted[2])["PIPELINE"] == ILLUM_MESSAGE["illum_pipeline"]
+    assert batch.submitted[3]["dependsOn"] == [{"jobId": "job-2"}]
+
+
+def test_pending_illumination_claim_keeps_message(handler, monkeypatch):
+    monkeypatch.setenv("PROFILE_TABLE", "profiles")
+    monkeypatch.setattr(handler.time, "sleep", lambda seconds: None)
+    # Another invocation claimed the cache and hasn't recorded its job yet
+    handler.claim_illumination(handler.load_config(), illum_cache(handler))
+
+    response = handler.handler(sqs_event([json.dumps([MESSAGE, ILLUM_MESSAGE]), json.dumps(MESSAGE)]), None)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "m0"}]}
+    assert handler._clients["sqs"].deleted == ["r1"]
+    # Nothing of the failed record is submitted, so its retry doesn't submit jobs twice
+    assert len(handler._clients["batch"].submitted) == 1
+
+
+def test_illumination_claim_released_when_submission_fails(handler, monkeypatch):
+    monkeypatch.setenv("PROFILE_TABLE", "profiles")
+
+    def submit_job(**kwargs):
+        raise RuntimeError("Batch is unavailable")
+
+    monkeypatch.setattr(handler._clients["batch"], "submit_job", submit_job)
+
+    response = handler.handler(sqs_event([json.dumps(ILLUM_MESSAGE)]), None)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "m0"}]}
+    assert handler._clients["dynamodb"].items == {}
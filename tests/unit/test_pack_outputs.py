@@ -0,0 +1,67 @@
+import importlib.util
+import os
+import tarfile
+
+import pytest
+
+PACK_OUTPUTS_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "docker", "pack-outputs.py")
+
+
+@pytest.fixture
+def pack_outputs():
+    spec = importlib.util.spec_from_file_location("pack_outputs", PACK_OUTPUTS_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.pack_outputs
+
+
+def write_outputs(source, files):
+    for relpath, data in files.items():
+        path = os.path.join(source, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+def test_ranged_reads_return_original_bytes(pack_outputs, tmp_path):
+    source, dest = tmp_path / "source", tmp_path / "dest"
+    files = {
+        "Image.csv": b"ImageNumber,Count\n1,42\n",
+        "masks/A01_s1.png": os.urandom(1500),
+        "masks/A01_s2.png": b"",
+        "overlays/A01_s1.tiff": os.urandom(4096),
+        "large.h5": os.urandom(10000),
+    }
+    write_outputs(source, files)
+
+    index = pack_outputs(str(source), str(dest), shard_size=1024 * 1024, small_file_size=8192)
+
+    assert index["direct"] == ["large.h5"]
+    # Large files stay in source to be uploaded directly, packed files are removed
+    assert [path.name for path in source.rglob("*") if path.is_file()] == ["large.h5"]
+    assert (source / "large.h5").read_bytes() == files["large.h5"]
+    assert not os.path.exists(dest / "large.h5")
+    assert sorted(index["files"]) == sorted(set(files) - {"large.h5"})
+    for relpath, entry in index["files"].items():
+        with open(dest / entry["shard"], "rb") as f:
+            f.seek(entry["offset"])
+            assert f.read(entry["size"]) == files[relpath]
+
+
+def test_new_shard_starts_at_size_limit(pack_outputs, tmp_path):
+    source, dest = tmp_path / "source", tmp_path / "dest"
+    write_outputs(source, {f"cell{i}.csv": os.urandom(6000) for i in range(5)})
+    # Two files with their headers and the end-of-archive blocks fit in two records. A third
+    # file's data alone would still fit under the limit, but not with its header and padding.
+    shard_size = 2 * tarfile.RECORDSIZE + 2 * tarfile.BLOCKSIZE
+
+    index = pack_outputs(str(source), str(dest), shard_size=shard_size, small_file_size=8192)
+
+    assert len(index["shards"]) == 3
+    assert [entry["shard"] for entry in index["files"].values()] == [
+        index["shards"][0], index["shards"][0], index["shards"][1], index["shards"][1], index["shards"][2]
+    ]
+    for shard in index["shards"]:
+        assert os.path.getsize(dest / shard) <= shard_size
+        with tarfile.open(dest / shard) as tar:
+            tar.getmembers()
@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from simulator.model import DEFAULT_CONFIG, Job, Message, simulate
+from simulator.sweep import main, sweep
+from simulator.trace import load_trace, synthetic_trace
+
+
+def test_single_job_makespan():
+    trace = [Message(0.0, [Job("plate1", cpu_seconds=600, input_mb=0)])]
+    result = simulate(trace, {"JOB_CPU": 2, "JOB_MEMORY": 2048, "INSTANCE_CLASS": "c5"})
+
+    expected = (DEFAULT_CONFIG["SIM_LAMBDA_POLL_LATENCY"] + DEFAULT_CONFIG["SIM_LAMBDA_SUBMIT_LATENCY"]
+                + DEFAULT_CONFIG["SIM_DISPATCH_LATENCY"] + DEFAULT_CONFIG["SIM_INSTANCE_BOOT_TIME"]
+                + DEFAULT_CONFIG["SIM_CONTAINER_START_TIME"] + 600)
+    assert result.makespan == pytest.approx(expected)
+    assert result.completed_jobs == 1
+    assert result.failed_jobs == 0
+    assert result.peak_vcpus == 2
+
+
+def test_compute_max_cpu_caps_capacity():
+    trace = synthetic_trace(plates=4, jobs_per_plate=50)
+    result = simulate(trace, {"COMPUTE_MAX_CPU": 64, "JOB_CPU": 1, "JOB_MEMORY": 3584, "INSTANCE_CLASS": "m5"})
+
+    assert result.peak_vcpus <= 64
+    assert result.completed_jobs == 200
+    assert 0 < result.utilisation <= result.allocation <= 1
+
+
+def test_out_of_memory_jobs_fail_after_all_attempts():
+    trace = [Message(0.0, [Job("plate1", cpu_seconds=60, peak_memory_mb=8192)])]
+    result = simulate(trace, {"JOB_MEMORY": 4096, "JOB_ATTEMPTS": 3})
+
+    assert result.completed_jobs == 0
+    assert result.failed_jobs == 1
+
+
+def test_short_visibility_timeout_duplicates_jobs():
+    trace = [Message(0.0, [Job("plate1", cpu_seconds=60) for _ in range(100)])]
+    result = simulate(trace, {"SQS_MESSAGE_VISIBILITY": 5, "SIM_LAMBDA_SUBMIT_LATENCY": 0.1})
+
+    assert result.duplicate_jobs == 100
+    assert result.completed_jobs == 200
+
+
+def test_sweep_covers_grid(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    path.write_text("\n".join(json.dumps(record) for record in [
+        {"submitted_at": 0, "body": {"input": "plate1/images/", "cpu_seconds": 300}},
+        {"submitted_at": 30, "body": [{"plate": "plate2", "cpu_seconds": 300, "input_mb": 100}] * 3},
+    ]))
+    trace = load_trace(path)
+
+    results = sweep(trace, {"JOB_CPU": [1, 2, 4], "INSTANCE_CLASS": ["c4", "c5"]})
+
+    assert len(results) == 6
+    assert [result.config["JOB_CPU"] for result in results] == [1, 1, 2, 2, 4, 4]
+    assert all(result.completed_jobs == 4 for result in results)
+    assert results[0].cost_per_plate == pytest.approx(results[0].cost / 2)
+
+
+def test_sweep_rejects_unknown_instance_class(capsys):
+    with pytest.raises(SystemExit):
+        main(["--plates", "1", "--set", "INSTANCE_CLASS=c5,c6i"])
+
+    assert "Unknown instance class: c6i" in capsys.readouterr().err
+
+
+def test_memory_bound_jobs_scale_out_in_one_boot():
+    # Only one 7000 MB job fits on an m5.large, whatever JOB_CPU is
+    trace = [Message(0.0, [Job("plate1", cpu_seconds=600, peak_memory_mb=5000) for _ in range(64)])]
+
+    results = [simulate(trace, dict(DEFAULT_CONFIG, INSTANCE_CLASS="m5", JOB_MEMORY=7000, JOB_CPU=job_cpu))
+               for job_cpu in (1, 4)]
+
+    assert all(result.completed_jobs == 64 for result in results)
+    assert results[0].makespan == pytest.approx(results[1].makespan)
+    assert results[0].makespan < 600 + DEFAULT_CONFIG["SIM_INSTANCE_BOOT_TIME"] * 2